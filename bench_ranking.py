@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+import time
+
+
+# Benchmarks the recommender:
+#   python bench_ranking.py [users] [items]
+# scores every one of `items` items for each of `users` users with the NumPy
+# core (100k x 1k by default), and
+#   python bench_ranking.py --db [users] [items per user]
+# runs the full ranking process on a scratch db: initial ranking of every
+# queue row, then the incremental update after a burst of resonance.
+
+
+def bench_core(users: int, items: int, sources: int = 500):
+    import numpy as np
+    import ranking
+
+    rng = np.random.default_rng(1)
+    types = rng.integers(0, len(ranking.TYPE_CODES), items)
+    created = rng.uniform(0, 90 * 24 * 3600, items)
+    source_codes = rng.integers(0, sources, items)
+    peer_count = rng.poisson(1, items).astype(float)
+    peer_sum = peer_count * rng.uniform(0, 100, items)
+    started = time.perf_counter()
+    for _ in range(users):
+        affinity = rng.uniform(-1, 1, sources)[source_codes]
+        scores = ranking.score_batch(types, created, affinity, peer_sum, peer_count)
+        top = np.argpartition(scores, -100)[-100:]
+        top[np.argsort(scores[top])[::-1]]
+    elapsed = time.perf_counter() - started
+    print(
+        f"Scored {users} users x {items} items in {elapsed:.2f}s, "
+        f"{users * items / elapsed / 1e6:.1f}M scores/s"
+    )
+
+
+def bench_db(users: int, items_per_user: int, events: int = 1000):
+    import random
+    from sqlalchemy import orm
+    from models import User, engine
+    import ranking
+    import store
+
+    random.seed(1)
+    feeds = [f"https://feed{i}.example/rss" for i in range(200)]
+    started = time.perf_counter()
+    with orm.Session(engine) as session:
+        for u in range(users):
+            email = f"user{u}@example.com"
+            session.add(User(email=email, auth_token_hash=email, is_admin=False))
+            links = random.sample(range(items_per_user * 20), items_per_user)
+            rows = [
+                dict(
+                    uid=f"{email}/{i}",
+                    uiuid=str(i),
+                    title=f"Item {i}",
+                    author=None,
+                    content=None,
+                    summary="",
+                    link=f"https://site{i % 1000}.example/{i}",
+                    article_uid=None,
+                    type="read" if i % 5 else "do",
+                    source=feeds[i % len(feeds)],
+                    peer_score=random.choice([None, None, 85, 95]),
+                )
+                for i in links
+            ]
+            store.insert_items(session, email, rows)
+        session.commit()
+    print(
+        f"Created {users * items_per_user} queue rows "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+    started, ranked = time.perf_counter(), 0
+    with orm.Session(engine) as session:
+        while count := ranking.rank_unscored(session):
+            session.commit()
+            ranked += count
+    elapsed = time.perf_counter() - started
+    print(f"Ranked {ranked} rows in {elapsed:.2f}s, {ranked / elapsed:.0f} rows/s")
+
+    with orm.Session(engine) as session:
+        ranking.rank_changed(session)
+        session.commit()
+        uids = [x.item_uid for x in ranking.queue_rows(session, limit=events * 10)]
+        for uid in random.sample(uids, events):
+            email = uid.split("/")[0]
+            store.record_event(
+                session, email, uid, "_resonance", random.randint(0, 100)
+            )
+        session.commit()
+    started = time.perf_counter()
+    with orm.Session(engine) as session:
+        rescored = ranking.rank_changed(session)
+        session.commit()
+    elapsed = time.perf_counter() - started
+    print(
+        f"Took in {events} resonance events by rescoring {rescored} rows "
+        f"in {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    # Never the real db
+    os.environ["WM_DB_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    args = sys.argv[1:]
+    if args and args[0] == "--db":
+        sizes = [int(x) for x in args[1:]] or [1000, 100]
+        bench_db(*sizes)
+    else:
+        sizes = [int(x) for x in args] or [1000, 100_000]
+        bench_core(*sizes)
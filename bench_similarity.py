@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import time
+
+
+# Benchmarks the similarity index:
+#   python bench_similarity.py [docs] [queries]
+# builds an index of `docs` synthetic articles with a Zipfian vocabulary
+# (100k by default), saves and reloads it, and times `queries` lookups.
+
+
+def bench(docs: int, queries: int, words: int = 50_000, length: int = 800):
+    import numpy as np
+    import similarity
+
+    rng = np.random.default_rng(1)
+    vocab = np.array([f"w{i}" for i in range(words)])
+    weights = 1 / np.arange(1, words + 1)
+    weights /= weights.sum()
+    index = similarity.SimilarityIndex()
+    started, tokenized = time.perf_counter(), 0.0
+    for start in range(0, docs, similarity.SIM_BATCH):
+        batch = []
+        for i in range(start, min(docs, start + similarity.SIM_BATCH)):
+            text = " ".join(vocab[rng.choice(words, length, p=weights)])
+            batch.append((str(i), text[:60], text[:300], text))
+        index.add(batch)
+    elapsed = time.perf_counter() - started
+    print(
+        f"Indexed {docs} docs in {elapsed:.1f}s ({docs / elapsed:.0f} docs/s), "
+        f"{index.matrix.nnz} stored weights"
+    )
+
+    path = os.path.join(tempfile.mkdtemp(), "index.npz")
+    started = time.perf_counter()
+    index.save(path)
+    saved = time.perf_counter() - started
+    started = time.perf_counter()
+    index = similarity.SimilarityIndex.load(path)
+    index.similar("0")
+    print(
+        f"Saved in {saved:.2f}s, loaded in {time.perf_counter() - started:.2f}s, "
+        f"{os.path.getsize(path) / 1e6:.0f}MB"
+    )
+
+    timings = []
+    for key in rng.choice(docs, queries).astype(str):
+        started = time.perf_counter()
+        index.similar(key)
+        timings.append(time.perf_counter() - started)
+    timings = np.array(timings) * 1000
+    print(
+        f"Queried {queries} times: p50 {np.percentile(timings, 50):.1f}ms, "
+        f"p99 {np.percentile(timings, 99):.1f}ms, max {timings.max():.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    # Never the real db
+    os.environ["WM_DB_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    sizes = [int(x) for x in sys.argv[1:]] or [100_000, 1000]
+    bench(*sizes)
@@ -1,132 +1,616 @@
-from models import Item, Source, User, ReadingItemData, engine
-import requests
-from sqlalchemy import orm, select
-from utils import generate_content_uid, link_to_md
-from rss_parser import Parser
+from models import Source, engine
+from sqlalchemy import func, or_, orm, select, update
+from utils import article_uid, generate_content_uid, link_to_md
+from html_to_md import stats as html_to_md_stats
+from diffbot import DIFFBOT_CONCURRENCY, CircuitOpenError, RetryableError
+from feed_stream import FeedStream
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from urllib.parse import urlparse
+import aiohttp
+import asyncio
+import dedup
+import json
+import os
+import scheduler
+import store
 import time
 
 
-def check_dup_and_stack(email: str, link: str) -> bool:
+MAX_CONCURRENT_FETCHES = int(os.environ.get("WM_INGEST_CONCURRENCY", 32))
+MAX_FETCHES_PER_HOST = int(os.environ.get("WM_INGEST_PER_HOST", 4))
+FETCH_TIMEOUT = float(os.environ.get("WM_FETCH_TIMEOUT", 20))
+CYCLE_INTERVAL = float(os.environ.get("WM_INGEST_INTERVAL", 1))
+# NDJSON is streamed by the peer and gzipped on the wire, plain JSON is the
+# fallback for older spiles
+SPILE_ACCEPT = "application/x-ndjson, application/json;q=0.5"
+# Spile feeds are followed over their /stream endpoint when the peer has one.
+# A stream that sees no data or heartbeat for STREAM_IDLE_TIMEOUT is dropped.
+STREAM_RETRY = float(os.environ.get("WM_STREAM_RETRY", 5))
+STREAM_UNSUPPORTED_RETRY = float(os.environ.get("WM_STREAM_UNSUPPORTED_RETRY", 3600))
+STREAM_IDLE_TIMEOUT = float(os.environ.get("WM_STREAM_IDLE_TIMEOUT", 45))
+# Articles of all feeds are extracted on one pool, the Diffbot client caps
+# the requests actually in flight and their rate
+extract_pool = ThreadPoolExecutor(DIFFBOT_CONCURRENCY, thread_name_prefix="extract")
+# RSS and Atom feeds are parsed as they're read, this much at a time
+FEED_CHUNK = 64 * 1024
+
+
+# Entries are parsed once per feed and fanned out to every subscriber. Their
+# `uid_parts` hash to the uiuid as is and to the per-user uid with the email
+# inserted before the link.
+def spile_entries(payload: str) -> list[dict]:
+    # Either a JSON list or, from peers that support it, one record per line
+    if payload.lstrip().startswith("["):
+        records = json.loads(payload)
+    else:
+        records = [json.loads(line) for line in payload.splitlines() if line]
+    entries = []
+    for item in records:
+        if item.get("removed"):
+            continue
+        reading_item = item["read"]
+        resonance = [x["resonance"] for x in item.get("reasons", []) if "resonance" in x]
+        entries.append(
+            dict(
+                peer_score=max(resonance, default=None),
+                author=reading_item["author"],
+                summary=reading_item["summary"],
+                title=reading_item["title"],
+                link=reading_item["link"],
+                content=reading_item["content"],
+                type=reading_item["type"],
+                uid_parts=[
+                    reading_item["content"],
+                    reading_item["type"],
+                    reading_item["link"],
+                ],
+            )
+        )
+    return entries
+
+
+def item_row(
+    entry: dict, email: str, source: str, article: str | None, status: str | None
+) -> dict:
+    parts = entry["uid_parts"]
+    return dict(
+        source=source,
+        peer_score=entry["peer_score"],
+        author=entry["author"],
+        summary=entry["summary"],
+        title=entry["title"],
+        link=entry["link"],
+        content=None,
+        article_uid=article,
+        type=entry["type"],
+        status=status,
+        uid=generate_content_uid(parts[:2] + [email] + parts[2:]),
+        uiuid=generate_content_uid(parts),
+    )
+
+
+def extract_content(link: str) -> str | Exception:
+    # Failures are returned so one link doesn't sink the rest of the batch
+    try:
+        return link_to_md(link)
+    except Exception as e:
+        return e
+
+
+def best_score(*scores: int | None) -> int | None:
+    return max((x for x in scores if x is not None), default=None)
+
+
+def consume_payload(payload: str, emails: list[str], url: str) -> dict:
+    # A spile feed, RSS and Atom are streamed by read_rss instead
+    return consume_entries(spile_entries(payload), emails, url)
+
+
+def consume_entries(entries: list[dict], emails: list[str], url: str) -> dict:
     with orm.Session(engine) as session:
-        res = (
-            session.execute(
-                select(Item).where(Item.user_email == email, Item.link == link)
+        seen = store.existing_links(session, emails, [x["link"] for x in entries])
+    new_entries = defaultdict(list)
+    needed = {}
+    for email in emails:
+        for entry in entries:
+            if entry["link"] not in seen[email]:
+                seen[email].add(entry["link"])
+                new_entries[email].append(entry)
+                needed[article_uid(entry["link"])] = entry
+    if not needed:
+        return {}
+
+    # Each article body is extracted and stored once, however many subscribers
+    # get it, and so is each story however many links it comes under: a near
+    # duplicate of a stored article (see dedup.py) is given that article
+    # instead. This happens outside of the write transaction so the DB lock
+    # isn't held for it. Links found to be duplicates are kept as aliases of
+    # the article so later polls don't extract them again.
+    with orm.Session(engine) as session:
+        stored = store.existing_articles(session, list(needed))
+        missing = {uid: x for uid, x in needed.items() if uid not in stored}
+        teasers = dedup.fingerprints(
+            {uid: f"{x['title']} {x['summary']}" for uid, x in missing.items()}
+        )
+        duplicates = dedup.resolve(session, "teaser", teasers)
+    aliased = {uid: x for uid, x in stored.items() if uid != x}
+    duplicates.update(aliased)
+    missing = {uid: x for uid, x in missing.items() if uid not in duplicates}
+    links = [x["link"] for x in missing.values() if x["content"] is None]
+    extracted = dict(zip(links, extract_pool.map(extract_content, links)))
+    # Entries whose extraction may yet work (an outage, the breaker open) are
+    # left out for the next poll, the others get a failed item like
+    # extraction.py gives up with
+    retry, failed = set(), set()
+    for uid, entry in missing.items():
+        error = extracted.get(entry["link"])
+        if isinstance(error, Exception):
+            print(f"Extracting `{entry['link']}` failed: {error!r}")
+            transient = isinstance(error, (RetryableError, CircuitOpenError))
+            (retry if transient else failed).add(uid)
+    articles = [
+        {
+            "uid": uid,
+            "link": entry["link"],
+            "title": entry["title"],
+            "author": entry["author"],
+            "content": entry["content"] or extracted[entry["link"]],
+        }
+        for uid, entry in missing.items()
+        if uid not in retry and uid not in failed
+    ]
+    contents = dedup.fingerprints({x["uid"]: x["content"] for x in articles})
+    with orm.Session(engine) as session:
+        duplicates.update(dedup.resolve(session, "content", contents))
+    duplicates = dedup.roots(duplicates)
+    articles = [x for x in articles if x["uid"] not in duplicates]
+    kept = {x["uid"] for x in articles}
+    # Those of an entry that fails or is retried have no article to point at
+    aliases = [
+        {"uid": uid, "link": needed[uid]["link"], "article_uid": article}
+        for uid, article in duplicates.items()
+        if uid not in aliased and article not in retry and article not in failed
+    ]
+    fingerprints = dedup.fingerprint_rows(
+        "teaser", {uid: x for uid, x in teasers.items() if uid in kept}
+    ) + dedup.fingerprint_rows(
+        "content", {uid: x for uid, x in contents.items() if uid in kept}
+    )
+
+    added = {}
+    with orm.Session(engine) as session:
+        store.insert_articles(session, articles)
+        store.insert_aliases(session, aliases)
+        store.insert_fingerprints(session, fingerprints)
+        # A story the user already has is merged into their item of it
+        held = store.article_items(
+            session,
+            list(new_entries),
+            list({duplicates.get(uid, uid) for uid in needed}),
+        )
+        for email, user_entries in new_entries.items():
+            rows, merged = {}, {}
+            for entry in user_entries:
+                article = article_uid(entry["link"])
+                article = duplicates.get(article, article)
+                if article in retry:
+                    continue
+                if (email, article) in held:
+                    uid = held[email, article]
+                    merged[uid] = best_score(merged.get(uid), entry["peer_score"])
+                elif article in rows:
+                    rows[article]["peer_score"] = best_score(
+                        rows[article]["peer_score"], entry["peer_score"]
+                    )
+                elif article in failed:
+                    rows[article] = item_row(entry, email, url, None, "failed")
+                else:
+                    rows[article] = item_row(entry, email, url, article, None)
+            store.merge_duplicates(
+                session, {uid: x for uid, x in merged.items() if x is not None}
             )
-            .scalars()
-            .first()
+            added[email] = len(store.insert_items(session, email, list(rows.values())))
+        session.commit()
+    if aliases:
+        print(f"Merged {len(aliases)} near-duplicate articles of `{url}`")
+    if retry:
+        # The rest is stored, failing the poll keeps the feed's validators and
+        # cursor where they were so the next one reads these entries again
+        raise RetryableError(f"{len(retry)} articles of `{url}` not extracted yet")
+    return added
+
+
+@dataclass
+class CycleStats:
+    started_at: float = field(default_factory=time.monotonic)
+    sources: int = 0
+    fetches: int = 0
+    unchanged: int = 0
+    failures: int = 0
+    items: int = 0
+    host_times: dict = field(default_factory=lambda: defaultdict(float))
+    source_updates: list = field(default_factory=list)
+
+    def report(self, slowest: int = 3) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        hosts = sorted(self.host_times.items(), key=lambda x: x[1], reverse=True)
+        slow = ", ".join(f"{host} ({t:.2f}s)" for host, t in hosts[:slowest])
+        return (
+            f"Ingested {self.sources} sources ({self.sources / elapsed:.1f}/s, "
+            f"{self.fetches} fetched, {self.unchanged} unchanged, {self.failures} failed), {self.items} "
+            f"items ({self.items / elapsed:.1f}/s) in {elapsed:.2f}s; "
+            f"slowest hosts: {slow or '-'}"
         )
-    if res:
-        # @TODO If item already exists merge all the `views` into one
-        return True
-    return False
 
 
-def consume_source(source: str, source_type: str, email: str):
+class FetchLimiter:
+    # Caps concurrent fetches overall and per host, on top of the connector limits
+    def __init__(self, total: int, per_host: int):
+        self.total = asyncio.Semaphore(total)
+        self.per_host = per_host
+        self.hosts = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+
+    async def fetch(
+        self,
+        http: aiohttp.ClientSession,
+        url: str,
+        headers: dict,
+        params: dict | None = None,
+    ) -> tuple[int, str | None, dict]:
+        async with self.total, self.hosts[urlparse(url).netloc]:
+            async with http.get(url, headers=headers, params=params) as resp:
+                if resp.status == 304:
+                    return resp.status, None, resp.headers
+                resp.raise_for_status()
+                return resp.status, await resp.text(), resp.headers
+
+    @asynccontextmanager
+    async def open(
+        self,
+        http: aiohttp.ClientSession,
+        url: str,
+        headers: dict,
+    ):
+        # Like fetch, but the body is left to be read from the response
+        async with self.total, self.hosts[urlparse(url).netloc]:
+            async with http.get(url, headers=headers) as resp:
+                if resp.status != 304:
+                    resp.raise_for_status()
+                yield resp
+
+
+def unseen_entries(
+    entries: list[dict], emails: list[str], previous: dict | None, read_all: bool
+) -> tuple[list[dict], int | None]:
+    # The entries some subscriber doesn't have yet, and where the rest of the
+    # feed can be skipped: at an entry every subscriber has that is older
+    # than the one before it, the feed runs newest first and what follows was
+    # taken in by earlier polls. Feeds in any other order, or without dates,
+    # are read to the end, and so is any feed with `read_all`.
+    with orm.Session(engine) as session:
+        seen = store.existing_links(session, emails, [x["link"] for x in entries])
+    unseen = []
+    for i, entry in enumerate(entries):
+        held = all(entry["link"] in seen[email] for email in emails)
+        if (
+            held
+            and not read_all
+            and previous is not None
+            and previous["published"] is not None
+            and entry["published"] is not None
+            and entry["published"] < previous["published"]
+        ):
+            return unseen, i
+        if not held:
+            unseen.append(entry)
+        previous = entry
+    return unseen, None
+
+
+async def read_rss(
+    http: aiohttp.ClientSession,
+    limiter: FetchLimiter,
+    url: str,
+    headers: dict,
+    emails: list[str],
+    read_all: bool,
+) -> tuple[int, dict, str | None, list[dict]]:
+    # (status, headers, content hash, new entries) of an RSS or Atom feed,
+    # parsed from the response as it streams in. The hash covers the entries
+    # read, which for an unchanged feed stop at the same one every poll.
+    async with limiter.open(http, url, headers) as resp:
+        if resp.status == 304:
+            return resp.status, resp.headers, None, []
+        stream = FeedStream()
+        links, new_entries, previous, done = [], [], None, False
+        chunks = resp.content.iter_chunked(FEED_CHUNK)
+        while not done:
+            chunk = await anext(chunks, None)
+            if chunk is None:
+                entries = await asyncio.to_thread(stream.close)
+                done = True
+            else:
+                entries = await asyncio.to_thread(stream.feed, chunk)
+            if not entries:
+                continue
+            unseen, stop_at = await asyncio.to_thread(
+                unseen_entries, entries, emails, previous, read_all
+            )
+            if stop_at is not None:
+                entries, done = entries[: stop_at + 1], True
+            new_entries += unseen
+            links += [x["link"] for x in entries]
+            previous = entries[-1]
+        return resp.status, resp.headers, generate_content_uid(links), new_entries
+
+
+async def consume_source(
+    http: aiohttp.ClientSession,
+    limiter: FetchLimiter,
+    stats: CycleStats,
+    sources: list[Source],
+):
+    # All `sources` share one feed url, it is fetched and parsed once for them
+    url, source_type = sources[0].source, sources[0].type
+    host = urlparse(url).netloc
+    started_at = time.monotonic()
+    request_headers = scheduler.conditional_headers(sources)
     if source_type == "spile":
-        all_items = requests.get(source).json()
-        for item in all_items:
-            reading_item = item["read"]
-            if not check_dup_and_stack(email, reading_item["link"]):
-                uid = generate_content_uid(
-                    [
-                        reading_item["content"],
-                        reading_item["type"],
-                        email,
-                        reading_item["link"],
-                    ]
+        request_headers["Accept"] = SPILE_ACCEPT
+    try:
+        payload, entries, content_hash = None, [], None
+        if source_type == "rss":
+            # A failed poll can have left entries out for the next one to
+            # take in (see consume_entries), they may be past the early stop
+            status, headers, content_hash, entries = await read_rss(
+                http,
+                limiter,
+                url,
+                request_headers,
+                [x.user_email for x in sources],
+                read_all=any(x.failure_count for x in sources),
+            )
+        else:
+            status, payload, headers = await limiter.fetch(
+                http, url, request_headers, scheduler.feed_params(sources)
+            )
+            if status != 304:
+                content_hash = generate_content_uid(payload)
+        stats.fetches += 1
+        stats.host_times[host] = max(
+            stats.host_times[host], time.monotonic() - started_at
+        )
+        new_items = {}
+        feed_cursor = None
+        if status != 304:
+            stale = [x.user_email for x in sources if x.content_hash != content_hash]
+            # Parsing, extraction and DB writes are blocking, keep them off the loop
+            if stale and payload is not None:
+                new_items = await asyncio.to_thread(
+                    consume_payload, payload, stale, url
                 )
-                uiuid = generate_content_uid(
-                    [
-                        reading_item["content"],
-                        reading_item["type"],
-                        reading_item["link"],
-                    ]
+            elif stale and entries:
+                new_items = await asyncio.to_thread(
+                    consume_entries, entries, stale, url
                 )
-                with orm.Session(engine) as session:
-                    session.add(
-                        Item(
-                            author=reading_item["author"],
-                            summary=reading_item["summary"],
-                            title=reading_item["title"],
-                            link=reading_item["link"],
-                            content=reading_item["content"],
-                            type=reading_item["type"],
-                            uid=uid,
-                            uiuid=uiuid,
-                            user_email=email,
-                        )
-                    )
+            stats.unchanged += len(sources) - len(stale)
+            # Only advanced once the entries up to it are stored
+            if headers.get("X-Feed-Cursor", "").isdigit():
+                feed_cursor = int(headers["X-Feed-Cursor"])
+        else:
+            stats.unchanged += len(sources)
+        now = datetime.utcnow()
+        for source in sources:
+            stats.items += new_items.get(source.user_email, 0)
+            stats.source_updates.append(
+                scheduler.record_poll(
+                    source,
+                    now,
+                    new_items.get(source.user_email, 0),
+                    etag=headers.get("ETag"),
+                    last_modified=headers.get("Last-Modified"),
+                    content_hash=content_hash,
+                    feed_cursor=feed_cursor,
+                )
+            )
+    except Exception as e:
+        stats.failures += len(sources)
+        now = datetime.utcnow()
+        stats.source_updates.extend(scheduler.record_failure(x, now) for x in sources)
+        print(f"Failed to consume `{url}` for {len(sources)} subscribers: {e!r}")
+    finally:
+        stats.sources += len(sources)
 
-                    session.add(
-                        ReadingItemData(
-                            item_uid=uid,
-                            item_order=None,
-                            archived=False,
-                            done=False,
-                            user_email=email,
-                        )
-                    )
-                    session.commit()
-    elif source_type == "rss":
-        rss_text = requests.get(source).text
-        rss = Parser.parse(rss_text)
-        for reading_item in rss.channel.items:
-            uid = generate_content_uid(
-                [
-                    reading_item.content.description.content,
-                    "read",
-                    email,
-                    reading_item.link,
-                ]
+
+async def sse_events(content: aiohttp.StreamReader):
+    # Yields (id, data) for each server-sent event. Lines are split by hand,
+    # a data line holds a whole entry and can outgrow aiohttp's readline limit.
+    event_id, data, buffer = None, [], b""
+    async for chunk in content.iter_any():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            line = raw.decode("utf-8").rstrip("\r")
+            if not line:
+                if data:
+                    yield event_id, "\n".join(data)
+                event_id, data = None, []
+                continue
+            name, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if name == "id":
+                event_id = value
+            elif name == "data":
+                data.append(value)
+
+
+def stream_cursor(url: str) -> int | None:
+    # Where a stream of `url` resumes, subscribers without a cursor are polled
+    with orm.Session(engine) as session:
+        return session.execute(
+            select(func.min(Source.feed_cursor)).where(
+                Source.source == url, Source.type == "spile"
+            )
+        ).scalar()
+
+
+def consume_pushed(url: str, payload: str, feed_cursor: int) -> int:
+    with orm.Session(engine) as session:
+        sources = (
+            session.execute(
+                select(Source).where(
+                    Source.source == url,
+                    Source.type == "spile",
+                    Source.feed_cursor != None,
+                )
             )
-            uiuid = generate_content_uid(
-                [
-                    reading_item.content.description.content,
-                    "read",
-                    reading_item.link,
-                ]
+            .scalars()
+            .all()
+        )
+    added = consume_payload(payload, [x.user_email for x in sources], url)
+    now = datetime.utcnow()
+    save_source_updates(
+        [
+            scheduler.record_poll(
+                x,
+                now,
+                added.get(x.user_email, 0),
+                feed_cursor=max(feed_cursor, x.feed_cursor),
             )
-            link = reading_item.content.link.content
-            if not check_dup_and_stack(email, link):
-                md = link_to_md(link)
-                with orm.Session(engine) as session:
-                    session.add(
-                        Item(
-                            author=reading_item.content.author.content
-                            if reading_item.content.author
-                            else None,
-                            summary=reading_item.content.description.content
-                            if reading_item.content.description
-                            else "",
-                            title=reading_item.content.title.content
-                            if reading_item.content.title
-                            else "",
-                            link=link,
-                            content=md,  # @TODO USE THE API!
-                            type="read",
-                            uid=uid,
-                            uiuid=uiuid,
-                            user_email=email,
-                        )
-                    )
-                    session.add(
-                        ReadingItemData(
-                            item_uid=uid,
-                            item_order=None,
-                            archived=False,
-                            done=False,
-                            user_email=email,
-                        )
+            for x in sources
+        ]
+    )
+    return sum(added.values())
+
+
+class FeedStreams:
+    # Push connections to peer spiles, one per feed url. Subscribers of a live
+    # stream aren't polled; when it drops they are polled again until it
+    # reconnects from the stored cursors.
+    def __init__(self, http: aiohttp.ClientSession):
+        self.http = http
+        self.tasks = {}
+        self.retry_at = {}
+
+    def live(self, url: str) -> bool:
+        task = self.tasks.get(url)
+        return task is not None and not task.done()
+
+    def start(self, url: str):
+        if self.live(url) or self.retry_at.get(url, 0) > time.monotonic():
+            return
+        self.tasks[url] = asyncio.create_task(self.follow(url))
+
+    async def follow(self, url: str):
+        retry = STREAM_RETRY
+        try:
+            feed_cursor = await asyncio.to_thread(stream_cursor, url)
+            if feed_cursor is None:
+                return
+            async with self.http.get(
+                url.rstrip("/") + "/stream",
+                params={"since": feed_cursor},
+                headers={"Accept": "text/event-stream"},
+            ) as resp:
+                if resp.status == 404:
+                    # The peer predates push, keep polling it
+                    retry = STREAM_UNSUPPORTED_RETRY
+                    return
+                resp.raise_for_status()
+                async for event_id, data in sse_events(resp.content):
+                    added = await asyncio.to_thread(
+                        consume_pushed, url, data, int(event_id)
                     )
-                    session.commit()
-    else:
-        raise ValueError(f"Unknown source type: `{source_type}` for source `{source}`!")
+                    if added:
+                        print(f"Pushed {added} items from `{url}`")
+        except Exception as e:
+            print(f"Stream of `{url}` dropped: {e!r}")
+        finally:
+            self.retry_at[url] = time.monotonic() + retry
+
+
+def open_http_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=MAX_CONCURRENT_FETCHES, limit_per_host=MAX_FETCHES_PER_HOST
+        ),
+        timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+    )
+
+
+def open_stream_session() -> aiohttp.ClientSession:
+    # Streams stay open indefinitely, so they get their own connection pool
+    # rather than holding on to the fetch slots
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0),
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=STREAM_IDLE_TIMEOUT),
+    )
+
+
+def due_sources_query(now: datetime):
+    return select(Source).where(
+        or_(Source.next_poll_at == None, Source.next_poll_at <= now)
+    )
+
+
+def due_sources(now: datetime) -> list[Source]:
+    with orm.Session(engine) as session:
+        return session.execute(due_sources_query(now)).scalars().all()
+
+
+def save_source_updates(source_updates: list[dict]):
+    if not source_updates:
+        return
+    with orm.Session(engine) as session:
+        session.execute(update(Source), source_updates)
+        session.commit()
+
+
+async def run_cycle(
+    http: aiohttp.ClientSession,
+    limiter: FetchLimiter,
+    streams: FeedStreams | None = None,
+) -> CycleStats:
+    sources = await asyncio.to_thread(due_sources, datetime.utcnow())
+    feeds = defaultdict(list)
+    for source in sources:
+        if (
+            streams is not None
+            and source.type == "spile"
+            and source.feed_cursor is not None
+            and streams.live(source.source)
+        ):
+            continue
+        feeds[(source.source, source.type)].append(source)
+    stats = CycleStats()
+    await asyncio.gather(
+        *[consume_source(http, limiter, stats, group) for group in feeds.values()]
+    )
+    await asyncio.to_thread(save_source_updates, stats.source_updates)
+    if streams is not None:
+        for url, source_type in feeds:
+            if source_type == "spile":
+                streams.start(url)
+    return stats
+
+
+async def run_ingestion():
+    limiter = FetchLimiter(MAX_CONCURRENT_FETCHES, MAX_FETCHES_PER_HOST)
+    async with open_http_session() as http, open_stream_session() as stream_http:
+        streams = FeedStreams(stream_http)
+        while True:
+            stats = await run_cycle(http, limiter, streams)
+            if stats.sources:
+                print(stats.report())
+            report = html_to_md_stats.take()
+            if report:
+                print(report)
+            await asyncio.sleep(CYCLE_INTERVAL)
 
 
 def refresh_data():
-    while True:
-        with orm.Session(engine) as session:
-            sources = session.execute(select(Source)).scalars().all()
-            for source in sources:
-                consume_source(source.source, source.type, source.user_email)
-        time.sleep(1)
+    asyncio.run(run_ingestion())
@@ -0,0 +1,123 @@
+from collections import defaultdict
+from hashlib import blake2b
+from models import ArticleFingerprint
+from sqlalchemy import orm, select
+import numpy as np
+import os
+import re
+
+
+# Near-duplicate articles: the same story syndicated under several links.
+# Texts are fingerprinted with a 64 bit SimHash over word shingles, and two
+# fingerprints at most DEDUP_DISTANCE bits apart are the same story. The
+# fingerprint is cut into BANDS bands of 16 bits, stored in
+# article_fingerprints; by pigeonhole two fingerprints fewer than BANDS bits
+# apart share at least one band, so a lookup is an index probe per band.
+# An entry's title and summary ("teaser") are checked before its article is
+# extracted, the extracted content before it is stored.
+DEDUP_DISTANCE = int(os.environ.get("WM_DEDUP_DISTANCE", 3))
+# Shorter texts are too generic to tell stories apart
+DEDUP_MIN_WORDS = int(os.environ.get("WM_DEDUP_MIN_WORDS", 8))
+SHINGLE = 2
+BANDS = 4
+KINDS = {"teaser": 0, "content": 1}
+WORD = re.compile(r"[^\W_]+")
+BITS = np.arange(64, dtype=np.uint64)
+
+
+def simhash(text: str | None) -> int | None:
+    # Signed, as SQLite stores it
+    words = WORD.findall((text or "").lower())
+    if len(words) < DEDUP_MIN_WORDS:
+        return None
+    shingles = {
+        " ".join(words[i : i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)
+    }
+    hashes = np.fromiter(
+        (blake2b(x.encode(), digest_size=8).digest() for x in shingles),
+        np.dtype("S8"),
+        len(shingles),
+    ).view(np.uint64)
+    # Each bit is set if most shingles have it set
+    votes = ((hashes[:, None] >> BITS) & np.uint64(1)).sum(axis=0)
+    bits = np.packbits(votes * 2 > len(shingles), bitorder="little")
+    return int(bits.view(np.int64)[0])
+
+
+def fingerprints(texts: dict[str, str | None]) -> dict[str, int]:
+    # The ones long enough to have one
+    hashes = {key: simhash(text) for key, text in texts.items()}
+    return {key: x for key, x in hashes.items() if x is not None}
+
+
+def bands(kind: str, fingerprint: int) -> list[int]:
+    # Kind, band number and the band's bits in one indexed integer
+    return [
+        KINDS[kind] << 20 | i << 16 | (fingerprint >> 16 * i) & 0xFFFF
+        for i in range(BANDS)
+    ]
+
+
+def distance(a: int, b: int) -> int:
+    return ((a ^ b) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def band_query(wanted: list[int]):
+    return select(
+        ArticleFingerprint.band,
+        ArticleFingerprint.article_uid,
+        ArticleFingerprint.fingerprint,
+    ).where(ArticleFingerprint.band.in_(wanted))
+
+
+def resolve(
+    session: orm.Session, kind: str, fingerprints: dict[str, int]
+) -> dict[str, str]:
+    # Article uid -> uid of the stored article it duplicates, or of one before
+    # it in `fingerprints`
+    candidates = defaultdict(list)
+    wanted = list({band for x in fingerprints.values() for band in bands(kind, x)})
+    for i in range(0, len(wanted), 500):
+        rows = session.execute(band_query(wanted[i : i + 500]))
+        for band, uid, fingerprint in rows:
+            candidates[band].append((uid, fingerprint))
+    duplicates = {}
+    for uid, fingerprint in fingerprints.items():
+        nearest = min(
+            (
+                (distance(fingerprint, other), other_uid)
+                for band in bands(kind, fingerprint)
+                for other_uid, other in candidates[band]
+                if other_uid != uid
+            ),
+            default=None,
+        )
+        if nearest is not None and nearest[0] <= DEDUP_DISTANCE:
+            duplicates[uid] = nearest[1]
+            continue
+        # Later entries of the batch can duplicate this one
+        for band in bands(kind, fingerprint):
+            candidates[band].append((uid, fingerprint))
+    return duplicates
+
+
+def roots(duplicates: dict[str, str]) -> dict[str, str]:
+    # A teaser duplicate of an earlier entry of the batch whose content then
+    # turned out to duplicate a stored article is that stored article
+    resolved = {}
+    for uid, other in duplicates.items():
+        seen = {uid}
+        while other in duplicates and other not in seen:
+            seen.add(other)
+            other = duplicates[other]
+        resolved[uid] = other
+    return resolved
+
+
+def fingerprint_rows(kind: str, fingerprints: dict[str, int]) -> list[dict]:
+    # article_fingerprints rows, see store.insert_fingerprints
+    return [
+        {"band": band, "article_uid": uid, "fingerprint": fingerprint}
+        for uid, fingerprint in fingerprints.items()
+        for band in bands(kind, fingerprint)
+    ]
@@ -0,0 +1,201 @@
+from requests.adapters import HTTPAdapter
+import os
+import random
+import requests
+import threading
+import time
+
+# Article extraction API. Point WM_DIFFBOT_URL at fake_diffbot.py to run
+# offline. The limits are per process, size them to the account's quota.
+# Without WM_DIFFBOT_TOKEN nothing is extracted, every article fails.
+DIFFBOT_URL = os.environ.get("WM_DIFFBOT_URL", "https://api.diffbot.com/v3/article")
+DIFFBOT_TOKEN = os.environ.get("WM_DIFFBOT_TOKEN")
+DIFFBOT_RATE = float(os.environ.get("WM_DIFFBOT_RATE", 5))
+DIFFBOT_BURST = int(os.environ.get("WM_DIFFBOT_BURST", 10))
+DIFFBOT_CONCURRENCY = int(os.environ.get("WM_DIFFBOT_CONCURRENCY", 8))
+DIFFBOT_TIMEOUT = float(os.environ.get("WM_DIFFBOT_TIMEOUT", 30))
+DIFFBOT_RETRIES = int(os.environ.get("WM_DIFFBOT_RETRIES", 3))
+DIFFBOT_BACKOFF = float(os.environ.get("WM_DIFFBOT_BACKOFF", 1))
+# Consecutive failures that open the breaker, and how long it stays open
+BREAKER_THRESHOLD = int(os.environ.get("WM_DIFFBOT_BREAKER_THRESHOLD", 5))
+BREAKER_COOLDOWN = float(os.environ.get("WM_DIFFBOT_BREAKER_COOLDOWN", 30))
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class CircuitOpenError(ExtractionError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a request may be sent
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Nothing goes out for `seconds`, e.g. after the API throttled us
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class CircuitBreaker:
+    # Stops calling a failing API for `cooldown` seconds after `threshold`
+    # failures in a row, then lets a single trial call through
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown or self.trial:
+                raise CircuitOpenError("Extraction API unavailable, circuit open")
+            self.trial = True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class RetryableError(ExtractionError):
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DiffbotClient:
+    def __init__(
+        self,
+        url: str = DIFFBOT_URL,
+        token: str | None = DIFFBOT_TOKEN,
+        rate: float = DIFFBOT_RATE,
+        burst: int = DIFFBOT_BURST,
+        concurrency: int = DIFFBOT_CONCURRENCY,
+        retries: int = DIFFBOT_RETRIES,
+    ):
+        self.url = url
+        self.token = token
+        self.retries = retries
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        # One keep-alive pool for every thread of the process
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    def _request(self, link: str) -> dict:
+        # Errors never include the request url, it carries the token
+        try:
+            resp = self.http.get(
+                self.url,
+                params={"url": link, "token": self.token},
+                timeout=DIFFBOT_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            raise RetryableError(f"{type(e).__name__} extracting `{link}`") from None
+        if resp.status_code == 429:
+            retry_after = resp.headers.get("Retry-After", "")
+            raise RetryableError(
+                f"HTTP 429 extracting `{link}`",
+                float(retry_after) if retry_after.isdigit() else DIFFBOT_BACKOFF,
+            )
+        if resp.status_code >= 500:
+            raise RetryableError(f"HTTP {resp.status_code} extracting `{link}`")
+        if resp.status_code >= 400:
+            raise ExtractionError(f"HTTP {resp.status_code} extracting `{link}`")
+        try:
+            body = resp.json()
+        except ValueError:
+            # An error page from a proxy in front of the API, say
+            raise RetryableError(f"Invalid response extracting `{link}`") from None
+        # Quota and upstream errors can also come back as a 200 with errorCode
+        code = body.get("errorCode")
+        if code == 429:
+            raise RetryableError(f"Error 429 extracting `{link}`", DIFFBOT_BACKOFF)
+        if (code or 0) >= 500:
+            raise RetryableError(
+                f"Error {code} extracting `{link}`: {body.get('error')}"
+            )
+        if not body.get("objects"):
+            raise ExtractionError(
+                f"Nothing extracted from `{link}`: {body.get('error', 'no objects')}"
+            )
+        return body["objects"][0]
+
+    def article(self, link: str) -> dict:
+        if not self.token:
+            raise ExtractionError(
+                f"WM_DIFFBOT_TOKEN is not set, can't extract `{link}`"
+            )
+        for attempt in range(self.retries + 1):
+            self.breaker.check()
+            self.bucket.acquire()
+            try:
+                with self.slots:
+                    article = self._request(link)
+            except RetryableError as e:
+                # Throttling means the API is up, only outages trip the breaker.
+                # It also ends a half-open trial, which would block every
+                # later call if left open.
+                if e.retry_after is None:
+                    self.breaker.failed()
+                else:
+                    self.breaker.succeeded()
+                if attempt == self.retries:
+                    raise
+                if e.retry_after is not None:
+                    # Every thread backs off at once, not just this one
+                    self.bucket.pause(e.retry_after * random.uniform(1, 1.5))
+                else:
+                    time.sleep(DIFFBOT_BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+                continue
+            except ExtractionError:
+                # The API answered, the page just couldn't be extracted
+                self.breaker.succeeded()
+                raise
+            except BaseException:
+                # Anything else is a failure too, or a half-open trial that
+                # raised it would keep the breaker open for good
+                self.breaker.failed()
+                raise
+            self.breaker.succeeded()
+            return article
+
+
+client = DiffbotClient()
@@ -0,0 +1,158 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from models import Article, ExtractionJob, Item, engine
+from sqlalchemy import delete, orm, select, update
+from utils import article_uid, get_all_from_link
+from html_to_md import html_to_md, stats as html_to_md_stats
+import os
+import random
+import store
+import time
+
+
+# Articles for items added without content are extracted here, in their own
+# process, instead of inside the /add_item request
+EXTRACT_WORKERS = int(os.environ.get("WM_EXTRACT_WORKERS", 4))
+EXTRACT_MAX_ATTEMPTS = int(os.environ.get("WM_EXTRACT_MAX_ATTEMPTS", 5))
+EXTRACT_RETRY_DELAY = float(os.environ.get("WM_EXTRACT_RETRY_DELAY", 30))
+EXTRACT_POLL_INTERVAL = float(os.environ.get("WM_EXTRACT_POLL_INTERVAL", 1))
+
+
+def extract(link: str) -> dict:
+    response = get_all_from_link(link)
+    return {
+        "title": response.get("title"),
+        "author": response.get("siteName"),
+        "content": html_to_md(response["html"], link),
+    }
+
+
+def due_jobs_query(now: datetime, limit: int):
+    return (
+        select(ExtractionJob.item_uid)
+        .where(
+            ExtractionJob.status == "pending",
+            ExtractionJob.next_attempt_at <= now,
+        )
+        .order_by(ExtractionJob.next_attempt_at)
+        .limit(limit)
+    )
+
+
+def claim_jobs(limit: int) -> list[ExtractionJob]:
+    due = due_jobs_query(datetime.utcnow(), limit)
+    with orm.Session(engine, expire_on_commit=False) as session:
+        jobs = (
+            session.execute(
+                update(ExtractionJob)
+                .where(ExtractionJob.item_uid.in_(due))
+                .values(status="running")
+                .returning(ExtractionJob),
+                execution_options={"synchronize_session": False},
+            )
+            .scalars()
+            .all()
+        )
+        session.commit()
+        return jobs
+
+
+def known_article(link: str) -> bool:
+    # Another user added or subscribed to the same link, nothing to fetch
+    with orm.Session(engine) as session:
+        return session.get(Article, article_uid(link)) is not None
+
+
+def complete_job(job: ExtractionJob, result: dict | None):
+    with orm.Session(engine) as session:
+        item = session.get(Item, job.item_uid)
+        if item is not None:
+            if result is not None:
+                store.insert_articles(
+                    session,
+                    [
+                        {
+                            "uid": article_uid(job.link),
+                            "link": job.link,
+                            "title": result["title"],
+                            "author": result["author"],
+                            "content": result["content"],
+                        }
+                    ],
+                )
+            # Also when another user's item of the link stored it already
+            article = session.get(Article, article_uid(job.link))
+            item.title = item.title or article.title
+            item.author = item.author or article.author
+            item.article_uid = article_uid(job.link)
+            item.status = None
+            store.mark_changed(session, item.user_email, item.uid, "extracted")
+        session.execute(
+            delete(ExtractionJob).where(ExtractionJob.item_uid == job.item_uid)
+        )
+        session.commit()
+
+
+def fail_job(job: ExtractionJob, error: Exception):
+    attempts = job.attempts + 1
+    values = {"attempts": attempts, "last_error": repr(error)}
+    if attempts >= EXTRACT_MAX_ATTEMPTS:
+        values["status"] = "failed"
+    else:
+        # Exponential backoff, jittered so a failed burst doesn't retry in step
+        delay = EXTRACT_RETRY_DELAY * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+        values["status"] = "pending"
+        values["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=delay)
+    with orm.Session(engine) as session:
+        session.execute(
+            update(ExtractionJob)
+            .where(ExtractionJob.item_uid == job.item_uid)
+            .values(**values)
+        )
+        if values["status"] == "failed":
+            item = session.get(Item, job.item_uid)
+            if item is not None:
+                item.status = "failed"
+                store.mark_changed(session, item.user_email, item.uid, "extracted")
+        session.commit()
+    print(f"Extracting `{job.link}` failed ({attempts} attempts): {error!r}")
+
+
+def run_job(job: ExtractionJob) -> dict | None:
+    if known_article(job.link):
+        return None
+    return extract(job.link)
+
+
+def run_extraction():
+    # Jobs left running by a previous run of this process are picked up again
+    with orm.Session(engine) as session:
+        session.execute(
+            update(ExtractionJob)
+            .where(ExtractionJob.status == "running")
+            .values(status="pending")
+        )
+        session.commit()
+
+    running = {}
+    with ThreadPoolExecutor(EXTRACT_WORKERS, thread_name_prefix="extract") as pool:
+        while True:
+            if len(running) < EXTRACT_WORKERS:
+                for job in claim_jobs(EXTRACT_WORKERS - len(running)):
+                    running[pool.submit(run_job, job)] = job
+            if not running:
+                time.sleep(EXTRACT_POLL_INTERVAL)
+                continue
+            finished, _ = wait(
+                running, timeout=EXTRACT_POLL_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            for future in finished:
+                job = running.pop(future)
+                try:
+                    complete_job(job, future.result())
+                except Exception as e:
+                    fail_job(job, e)
+            if not running:
+                report = html_to_md_stats.take()
+                if report:
+                    print(report)
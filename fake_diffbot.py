@@ -0,0 +1,186 @@
+from aiohttp import web
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+from html import escape
+import asyncio
+import os
+import random
+import sys
+import time
+
+# Stand-in for the Diffbot article API and for RSS feeds to ingest, so
+# ingestion can be tested and benchmarked offline:
+#   python fake_diffbot.py 8090
+#   WM_DIFFBOT_URL=http://localhost:8090/v3/article WM_DIFFBOT_TOKEN=fake python main.py
+# and subscribe to http://localhost:8090/rss/<name>?items=<n> (or /atom/,
+# with &padding=<bytes per entry> for large feeds and &missing=<n> for
+# entries whose page can't be downloaded). Like the real
+# API it throttles past its rate limit, and it can add latency and errors.
+LATENCY = float(os.environ.get("WM_FAKE_DIFFBOT_LATENCY", 0.2))
+RATE = float(os.environ.get("WM_FAKE_DIFFBOT_RATE", 0))
+ERROR_RATE = float(os.environ.get("WM_FAKE_DIFFBOT_ERROR_RATE", 0))
+PARAGRAPHS = int(os.environ.get("WM_FAKE_DIFFBOT_PARAGRAPHS", 20))
+
+WORDS = (
+    "the quick brown fox jumps over a lazy dog while reading long articles "
+    "about feeds queues meaning attention and the slow craft of writing"
+).split()
+# Enough words that different articles read differently, see dedup.py
+VOCABULARY = [a + b for a in WORDS for b in WORDS]
+
+
+def article_html(link: str) -> tuple[str, str]:
+    # Same link, same article
+    rng = random.Random(md5(link.encode()).hexdigest())
+    title = " ".join(rng.choices(WORDS, k=6)).capitalize()
+    paragraphs = [
+        " ".join(rng.choices(VOCABULARY, k=rng.randint(40, 120))).capitalize() + "."
+        for _ in range(PARAGRAPHS)
+    ]
+    body = "".join(f"<p>{x}</p>" for x in paragraphs)
+    return title, f"<h2>{title}</h2>{body}"
+
+
+class Quota:
+    # Requests allowed in the current one second window
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.window = 0
+        self.used = 0
+
+    def take(self) -> bool:
+        if not self.rate:
+            return True
+        window = int(time.monotonic())
+        if window != self.window:
+            self.window, self.used = window, 0
+        self.used += 1
+        return self.used <= self.rate
+
+
+async def article(request: web.Request) -> web.Response:
+    stats = request.app["stats"]
+    stats["requests"] += 1
+    link = request.query.get("url")
+    if not request.query.get("token"):
+        return web.json_response({"errorCode": 401, "error": "Not authorized"})
+    if not link:
+        return web.json_response({"errorCode": 500, "error": "No url given"})
+    if not request.app["quota"].take():
+        stats["throttled"] += 1
+        return web.json_response(
+            {"errorCode": 429, "error": "Too many requests"},
+            status=429,
+            headers={"Retry-After": "1"},
+        )
+    await asyncio.sleep(LATENCY)
+    if "/missing/" in link:
+        return web.json_response(
+            {"errorCode": 404, "error": "Could not download page (404)"}
+        )
+    if random.random() < ERROR_RATE:
+        stats["errors"] += 1
+        return web.json_response({"error": "Upstream failure"}, status=502)
+    stats["extracted"] += 1
+    title, html = article_html(link)
+    return web.json_response(
+        {
+            "request": {"pageUrl": link, "api": "article"},
+            "objects": [
+                {
+                    "type": "article",
+                    "pageUrl": link,
+                    "title": title,
+                    "siteName": "Fake Diffbot",
+                    "html": html,
+                    "text": html,
+                }
+            ],
+        }
+    )
+
+
+def feed_entries(request: web.Request) -> tuple[str, str, list[tuple]]:
+    # (name, base url, [(index, link, published)]), newest first. Entries
+    # are published an hour apart, the oldest `missing` link to dead pages.
+    name = request.match_info["name"]
+    count = int(request.query.get("items", 20))
+    missing = int(request.query.get("missing", 0))
+    base = f"{request.scheme}://{request.host}"
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    entries = [
+        (
+            i,
+            f"{base}/{'missing' if i < missing else 'articles'}/{name}/{i}",
+            start + timedelta(hours=i),
+        )
+        for i in reversed(range(count))
+    ]
+    return name, base, entries
+
+
+def padding(request: web.Request) -> str:
+    # Full-content archives: `padding` bytes of extra text per entry
+    return escape("x" * int(request.query.get("padding", 0)))
+
+
+async def rss(request: web.Request) -> web.Response:
+    name, base, entries = feed_entries(request)
+    extra = padding(request)
+    items = "".join(
+        f"<item><title>{name} {i}</title>"
+        f"<link>{link}</link>"
+        f"<description>Entry {i} of {name}{extra}</description>"
+        f"<pubDate>{format_datetime(date, usegmt=True)}</pubDate></item>"
+        for i, link, date in entries
+    )
+    return web.Response(
+        text=(
+            '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f"<title>{name}</title><link>{base}/rss/{name}</link>"
+            f"<description>Fake feed {name}</description>{items}</channel></rss>"
+        ),
+        content_type="application/rss+xml",
+    )
+
+
+async def atom(request: web.Request) -> web.Response:
+    name, base, entries = feed_entries(request)
+    extra = padding(request)
+    items = "".join(
+        f"<entry><title>{name} {i}</title><id>{link}</id>"
+        f'<link rel="alternate" href="{link}"/>'
+        f"<author><name>Fake Diffbot</name></author>"
+        f"<summary>Entry {i} of {name}{extra}</summary>"
+        f"<updated>{date.isoformat()}</updated></entry>"
+        for i, link, date in entries
+    )
+    return web.Response(
+        text=(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<feed xmlns="http://www.w3.org/2005/Atom">'
+            f"<title>{name}</title><id>{base}/atom/{name}</id>{items}</feed>"
+        ),
+        content_type="application/atom+xml",
+    )
+
+
+async def stats(request: web.Request) -> web.Response:
+    return web.json_response(request.app["stats"])
+
+
+def make_app() -> web.Application:
+    app = web.Application()
+    app["quota"] = Quota(RATE)
+    app["stats"] = {"requests": 0, "extracted": 0, "throttled": 0, "errors": 0}
+    app.router.add_get("/v3/article", article)
+    app.router.add_get("/rss/{name}", rss)
+    app.router.add_get("/atom/{name}", atom)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8090
+    web.run_app(make_app(), port=port)
@@ -0,0 +1,157 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from hashlib import sha256
+import markdownify
+import os
+import sqlite3
+import threading
+import time
+
+
+# markdownify is pure Python and CPU bound, conversions run on a process pool
+# so ingestion and extraction aren't capped at one core. 0 converts inline.
+MD_WORKERS = int(os.environ.get("WM_MD_WORKERS", os.cpu_count() or 1))
+# Converted articles by hash of their html, in their own db so cache writes
+# never wait on the main db's write lock
+MD_CACHE_PATH = os.environ.get("WM_MD_CACHE_PATH", "markdown_cache.db")
+MD_CACHE_BYTES = int(os.environ.get("WM_MD_CACHE_BYTES", 256 << 20))
+# Eviction needs a scan, so it only runs every this many writes
+EVICT_EVERY = 100
+# Hits refresh an entry's LRU position at most this often (seconds)
+TOUCH_AFTER = 60 * 60
+
+
+def convert(html: str) -> str:
+    return markdownify.markdownify(html, heading_style="ATX")
+
+
+@dataclass
+class ConversionStats:
+    conversions: int = 0
+    cache_hits: int = 0
+    seconds: float = 0
+    slowest: float = 0
+    html_bytes: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, seconds: float, html_bytes: int):
+        with self.lock:
+            self.conversions += 1
+            self.seconds += seconds
+            self.slowest = max(self.slowest, seconds)
+            self.html_bytes += html_bytes
+
+    def hit(self):
+        with self.lock:
+            self.cache_hits += 1
+
+    def take(self) -> str | None:
+        # Report since the last call, None if nothing happened
+        with self.lock:
+            if not self.conversions and not self.cache_hits:
+                return None
+            average = self.seconds / max(self.conversions, 1)
+            report = (
+                f"Converted {self.conversions} articles "
+                f"({self.html_bytes / 1024:.0f}kB of html, {self.cache_hits} cached) "
+                f"in {self.seconds:.2f}s of conversion time; "
+                f"avg {average * 1000:.0f}ms, slowest {self.slowest * 1000:.0f}ms"
+            )
+            self.conversions = self.cache_hits = self.html_bytes = 0
+            self.seconds = self.slowest = 0
+            return report
+
+
+class MarkdownCache:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.writes = 0
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS markdown (
+                    key TEXT PRIMARY KEY, link TEXT, markdown TEXT,
+                    size INTEGER, used_at REAL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS ix_used_at ON markdown (used_at)")
+        return db
+
+    def get(self, key: str) -> str | None:
+        db = self._db()
+        row = db.execute(
+            "SELECT markdown, used_at FROM markdown WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_AFTER:
+            with db:
+                db.execute("UPDATE markdown SET used_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, link: str | None, markdown: str):
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO markdown VALUES (?, ?, ?, ?, ?)",
+                (key, link, markdown, len(markdown.encode()), time.time()),
+            )
+        self.writes += 1
+        if self.writes % EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        # Drop the least recently used entries until under the budget
+        db = self._db()
+        total = db.execute("SELECT coalesce(sum(size), 0) FROM markdown").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess, keys = total - self.max_bytes, []
+        rows = db.execute("SELECT key, size FROM markdown ORDER BY used_at")
+        for key, size in rows:
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        rows.close()
+        with db:
+            db.executemany("DELETE FROM markdown WHERE key = ?", keys)
+
+
+stats = ConversionStats()
+cache = MarkdownCache(MD_CACHE_PATH, MD_CACHE_BYTES)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool() -> ProcessPoolExecutor:
+    # Created on first use, in the process that converts
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(MD_WORKERS)
+        return _pool
+
+
+def html_to_md(html: str, link: str | None = None) -> str:
+    # Safe to call from many threads at once, they convert in parallel
+    key = sha256(html.encode()).hexdigest()
+    markdown = cache.get(key)
+    if markdown is not None:
+        stats.hit()
+        return markdown
+    started = time.perf_counter()
+    markdown = pool().submit(convert, html).result() if MD_WORKERS else convert(html)
+    stats.record(time.perf_counter() - started, len(html))
+    cache.put(key, link, markdown)
+    return markdown
@@ -1,34 +1,324 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import texttospeech
-from pydub import AudioSegment
-from pydub.playback import play
-import io
+from models import Item, ReadingItemData, engine
+from sqlalchemy import desc, func, orm, select
+import asyncio
+import fcntl
+import os
+import re
+import tempfile
 
+sidney = {"language_code": "en-AU", "name": "en-AU-Standard-C"}
 
-sidney = {"language_code": "en-GB", "name": "en-AU-Standard-C"}
+MP3_CACHE_DIR = os.environ.get("WM_MP3_CACHE_DIR", "mp3_cache")
+MP3_CACHE_BYTES = int(os.environ.get("WM_MP3_CACHE_BYTES", 1 << 30))
+RENDER_LOCK_POLL = 0.25
+# Render the first N unread items of every queue ahead of time, 0 to disable
+PREGENERATE_TOP = int(os.environ.get("WM_MP3_PREGENERATE_TOP", 0))
+PREGENERATE_INTERVAL = float(os.environ.get("WM_MP3_PREGENERATE_INTERVAL", 300))
+# Google takes at most 5000 bytes of input per request
+TTS_CHUNK_BYTES = int(os.environ.get("WM_TTS_CHUNK_BYTES", 4500))
+TTS_WORKERS = int(os.environ.get("WM_TTS_WORKERS", 4))
+# "google", or "silent" to synthesize silence of about the right length offline
+TTS_BACKEND = os.environ.get("WM_TTS_BACKEND", "google")
 
+# Shared by all requests of a worker, bounds the TTS calls in flight
+tts_pool = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
 
-def item_to_mp3(content: str, uiuid: str):
+
+def speakable(markdown: str) -> str:
+    # Drop the markdown syntax that would otherwise be read out
+    text = re.sub(r"!\[[^\]]*\]\([^)]*\)", "", markdown)
+    text = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", text)
+    text = re.sub(r"^\s{0,3}(#{1,6}|>|[-*+]|\d+\.)\s+", "", text, flags=re.M)
+    text = re.sub(r"[*_`~]+", "", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def split_text(text: str, max_bytes: int = TTS_CHUNK_BYTES) -> list[str]:
+    # Pack whole sentences into chunks of at most `max_bytes`, a sentence that
+    # doesn't fit on its own is split between words
+    pieces = []
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        while len(sentence.encode()) > max_bytes:
+            cut = sentence.encode()[:max_bytes].decode(errors="ignore")
+            cut = cut.rsplit(" ", 1)[0] if " " in cut else cut
+            pieces.append(cut)
+            sentence = sentence[len(cut) :].lstrip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks = []
+    for piece in pieces:
+        if chunks and len(f"{chunks[-1]} {piece}".encode()) <= max_bytes:
+            chunks[-1] = f"{chunks[-1]} {piece}"
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def strip_id3(mp3: bytes) -> bytes:
+    # Chunks are concatenated frame streams, a tag mid-stream would be noise
+    if mp3[:3] != b"ID3" or len(mp3) < 10:
+        return mp3
+    size = 0
+    for byte in mp3[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    return mp3[10 + size :]
+
+
+_google_client = None
+
+
+def google_synthesize(text: str) -> bytes:
+    global _google_client
+    if _google_client is None:
+        _google_client = texttospeech.TextToSpeechClient()
+    response = _google_client.synthesize_speech(
+        request={
+            "input": texttospeech.SynthesisInput(text=text),
+            "voice": texttospeech.VoiceSelectionParams(**sidney),
+            "audio_config": texttospeech.AudioConfig(
+                audio_encoding=texttospeech.AudioEncoding.MP3
+            ),
+        }
+    )
+    return response.audio_content
+
+
+# A silent MPEG-1 layer III frame, 128kbps 44.1kHz: 417 bytes, 26ms of audio
+SILENT_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+
+
+def silent_synthesize(text: str) -> bytes:
+    # Offline stand-in, about as long as reading `text` at 150 words a minute
+    seconds = len(text.split()) / 2.5
+    return SILENT_FRAME * max(1, int(seconds * 44100 / 1152))
+
+
+SYNTHESIZERS = {"google": google_synthesize, "silent": silent_synthesize}
+
+
+async def synthesize_chunks(content: str, synthesize):
+    # Up to TTS_WORKERS chunks run ahead on the TTS pool and come out in order
+    # as soon as each is done, so one long article can't monopolize the pool
+    loop = asyncio.get_running_loop()
+    chunks = iter(split_text(speakable(content)))
+    pending = deque()
+
+    def submit():
+        chunk = next(chunks, None)
+        if chunk is not None:
+            pending.append(loop.run_in_executor(tts_pool, synthesize, chunk))
+
+    for _ in range(TTS_WORKERS):
+        submit()
     try:
-        with open(f"mp3_cache/{uiuid}.mp3", "rb") as fp:
-            mp3 = fp.read()
-    except:
-        client = texttospeech.TextToSpeechClient()
-        voice = texttospeech.VoiceSelectionParams(content, sidney)
-
-        audio_config = texttospeech.AudioConfig(
-            audio_encoding=texttospeech.AudioEncoding.MP3
-        )
+        while pending:
+            part = strip_id3(await pending.popleft())
+            submit()
+            yield part
+    finally:
+        for future in pending:
+            future.cancel()
 
-        response = client.synthesize_speech(
-            request={
-                "input": texttospeech.SynthesisInput(text=content),
-                "voice": voice,
-                "audio_config": audio_config,
-            }
+
+class Render:
+    # One synthesis in progress, every request for the item follows it
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        # The loop only keeps a weak reference to the task running it
+        self.task = None
+
+    def publish(self, part: bytes | None = None, error: Exception | None = None):
+        if part is not None:
+            self.parts.append(part)
+        self.error = error
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self):
+        i = 0
+        while True:
+            if i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+                continue
+            if self.error is not None:
+                raise self.error
+            if self.done:
+                return
+            await self.changed.wait()
+
+
+class Mp3Cache:
+    # Rendered audio by uiuid, shared by the workers and the pre-generator.
+    # Files are written atomically, hits refresh the mtime and the least
+    # recently used files are evicted once the directory outgrows max_bytes.
+    # A synthesis runs once: requests in the same process follow the running
+    # render, other processes wait on its lock file and then read the cache.
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.renders = {}
+
+    def path(self, uiuid: str) -> str:
+        return os.path.join(self.directory, f"{uiuid}.mp3")
+
+    def touch(self, uiuid: str) -> bool:
+        try:
+            os.utime(self.path(uiuid))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def open_cached(self, uiuid: str):
+        # Opened rather than checked, it can't be evicted from under the reader
+        try:
+            fp = open(self.path(uiuid), "rb")
+        except FileNotFoundError:
+            return None
+        os.utime(fp.fileno())
+        return fp
+
+    def put(self, uiuid: str, mp3: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(mp3)
+            os.replace(tmp, self.path(uiuid))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    async def _lock(self, uiuid: str):
+        # flock without blocking the loop, polled while another process renders.
+        # Lock files stay behind: removing one another process has open would
+        # let a third lock a new file while the second holds the old one.
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            fd = os.open(
+                os.path.join(self.directory, f"{uiuid}.lock"), os.O_CREAT | os.O_RDWR
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+                await asyncio.sleep(RENDER_LOCK_POLL)
+
+    async def _render(self, uiuid: str, content: str, synthesize, render: Render):
+        fd = await self._lock(uiuid)
+        try:
+            fp = await asyncio.to_thread(self.open_cached, uiuid)
+            if fp is not None:
+                with fp:
+                    render.publish(await asyncio.to_thread(fp.read))
+            else:
+                async for part in synthesize_chunks(content, synthesize):
+                    render.publish(part)
+                # Nothing to read out, don't cache that for when there is
+                if render.parts:
+                    await asyncio.to_thread(self.put, uiuid, b"".join(render.parts))
+            render.done = True
+            render.publish()
+        except Exception as e:
+            render.publish(error=e)
+        finally:
+            del self.renders[uiuid]
+            os.close(fd)
+
+    def render(self, uiuid: str, content: str, synthesize) -> Render:
+        # The render runs to completion even if its requests go away, so the
+        # audio is cached for the next one
+        render = self.renders.get(uiuid)
+        if render is None:
+            render = self.renders[uiuid] = Render()
+            render.task = asyncio.create_task(
+                self._render(uiuid, content, synthesize, render)
+            )
+        return render
+
+
+mp3_cache = Mp3Cache(MP3_CACHE_DIR, MP3_CACHE_BYTES)
+
+
+async def stream_mp3(content: str, uiuid: str, synthesize=None):
+    # Yields the MP3 as it's synthesized, or from the cache. Disk reads run on
+    # a thread, a slow disk mustn't stall the loop.
+    fp = await asyncio.to_thread(mp3_cache.open_cached, uiuid)
+    if fp is not None:
+        with fp:
+            while block := await asyncio.to_thread(fp.read, 1 << 18):
+                yield block
+        return
+    render = mp3_cache.render(uiuid, content, synthesize or SYNTHESIZERS[TTS_BACKEND])
+    async for part in render.follow():
+        yield part
+
+
+def queue_heads(top: int) -> list[tuple[str, str]]:
+    # (uiuid, content) of the first `top` unread items in every user's queue,
+    # leaving out those whose article isn't extracted
+    ranked = (
+        select(
+            ReadingItemData.item_uid,
+            func.row_number()
+            .over(
+                partition_by=ReadingItemData.user_email,
+                order_by=desc(ReadingItemData.item_order),
+            )
+            .label("position"),
         )
+        .where(ReadingItemData.archived == False, ReadingItemData.done == False)
+        .subquery()
+    )
+    with orm.Session(engine) as session:
+        items = session.execute(
+            select(Item)
+            .join(ranked, ranked.c.item_uid == Item.uid)
+            .where(ranked.c.position <= top, Item.status.is_(None))
+            .options(orm.selectinload(Item.article))
+        ).scalars()
+        return [(x.uiuid, x.full_content or "") for x in items]
+
+
+async def pregenerate(top: int):
+    synthesize = SYNTHESIZERS[TTS_BACKEND]
+    while True:
+        for uiuid, content in await asyncio.to_thread(queue_heads, top):
+            if mp3_cache.touch(uiuid):
+                continue
+            try:
+                async for _ in mp3_cache.render(uiuid, content, synthesize).follow():
+                    pass
+            except Exception as e:
+                print(f"Failed to pre-generate audio for `{uiuid}`: {e!r}")
+        await asyncio.sleep(PREGENERATE_INTERVAL)
 
-        mp3 = response.audio_content
-        with open(f"mp3_cache/{uiuid}.mp3", "wb") as fp:
-            fp.write(mp3)
 
-    return mp3
+def pregenerate_audio():
+    # Keeps the heads of the queues rendered so /get_mp3 on them is a cache hit
+    asyncio.run(pregenerate(PREGENERATE_TOP))
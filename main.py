@@ -1,44 +1,140 @@
 import datetime
+import hmac
+import json
 import multiprocessing
 import sys
-from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
 import os
 import uvicorn
 from pydantic import BaseModel
 from typing import List, Optional
 import aiohttp
-from typing import Annotated, Tuple
+from typing import Annotated, Literal, Tuple
 import asyncio
 import threading
 import time
+import zlib
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from cron_consumer import refresh_data
-from item_to_mp3 import item_to_mp3
-from utils import generate_auth_token, generate_content_uid, link_to_md, get_all_from_link
-from models import Item, ReadingItemData, Source, User, engine
-from sqlalchemy import desc, orm, select
+from extraction import run_extraction
+from ranking import run_ranking
+from similarity import run_similarity
+from item_to_mp3 import PREGENERATE_TOP, pregenerate_audio, stream_mp3
+from utils import (
+    TTLCache,
+    accepts,
+    decode_cursor,
+    encode_cursor,
+    fts_phrase,
+    fts_query,
+    generate_auth_token,
+    generate_content_uid,
+    hash_auth_token,
+    make_stream_token,
+    read_stream_token,
+    stream_token_signature,
+    http_date,
+    link_to_md,
+    not_modified,
+)
+from models import (
+    ExtractionJob,
+    FeedEntry,
+    Item,
+    ReadingItemData,
+    Source,
+    User,
+    async_engine,
+    items_fts,
+)
+from notify import SSE_HEARTBEAT, CounterWatch, sse_event
+import diffbot
+import similarity
+import store
+from sqlalchemy import and_, desc, func, literal_column, or_, orm, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from utils import detect_source_type, link_to_md
 import os
-import markdownify
 
 
-async def auth(req: Request):
-    auth_token = req.headers.get("auth_token", None)
-    with orm.Session(engine) as session:
-        if auth_token is None:
-            raise HTTPException(status_code=401, detail="No auth provided")
-        if os.environ.get("GLOBAL_AUTH_TOKEN") == auth_token:
-            return None, True
+# Per worker cache of token hash -> (email, is_admin), so authenticated
+# requests don't each pay a db lookup
+auth_cache = TTLCache(
+    maxsize=int(os.environ.get("WM_AUTH_CACHE_SIZE", 10_000)),
+    ttl=float(os.environ.get("WM_AUTH_CACHE_TTL", 60)),
+)
+
+# Wake /get_feed and /get_changes streams when any feed/queue changes, see notify.py
+feed_watch = CounterWatch("feed")
+changes_watch = CounterWatch("changes")
+FEED_EVENT_BATCH = 100
+CHANGES_EVENT_BATCH = 500
+MAX_LINKS_PER_REQUEST = 500
+STREAM_TOKEN_TTL = float(os.environ.get("WM_STREAM_TOKEN_TTL", 300))
+
+
+def invalidate_auth(email: str):
+    # Call whenever a user's token changes. Other workers catch up within the TTL.
+    auth_cache.invalidate(lambda _, identity: identity[0] == email)
+
 
+async def auth(req: Request):
+    return await identify(req.headers.get("auth_token", None))
+
+
+async def stream_auth(req: Request):
+    # EventSource can't set headers, so streams also take a short lived token
+    # from /stream_token as a param. The auth token itself never goes in a url,
+    # where logs and browser history would keep it.
+    if "auth_token" in req.headers:
+        return await auth(req)
+    stream_token = req.query_params.get("stream_token")
+    if stream_token is None:
+        raise HTTPException(status_code=401, detail="No auth provided")
+    try:
+        email, expires, signature = read_stream_token(stream_token)
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if expires < time.time():
+        raise HTTPException(status_code=401, detail="Stream token expired")
+    async with AsyncSession(async_engine) as session:
         user = (
-            session.execute(select(User).where(User.auth_token == auth_token))
-            .scalars()
-            .first()
-        )
+            await session.execute(
+                select(User.auth_token_hash, User.is_admin).where(User.email == email)
+            )
+        ).first()
+    if user is None or not hmac.compare_digest(
+        signature, stream_token_signature(email, expires, user.auth_token_hash)
+    ):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return email, user.is_admin
+
+
+async def identify(auth_token: str | None) -> tuple:
+    if auth_token is None:
+        raise HTTPException(status_code=401, detail="No auth provided")
+    if os.environ.get("GLOBAL_AUTH_TOKEN") == auth_token:
+        return None, True
+
+    auth_token_hash = hash_auth_token(auth_token)
+    identity = auth_cache.get(auth_token_hash)
+    if identity is None:
+        async with AsyncSession(async_engine) as session:
+            user = (await session.execute(identity_query(auth_token_hash))).first()
         if user is None:
             raise HTTPException(status_code=401, detail="Unauthorized")
+        identity = (user.email, user.is_admin)
+        auth_cache.set(auth_token_hash, identity)
 
-        return user.email, user.is_admin
+    return identity
+
+
+def identity_query(auth_token_hash: str):
+    return select(User.email, User.is_admin).where(
+        User.auth_token_hash == auth_token_hash
+    )
 
 
 app = FastAPI()
@@ -57,24 +153,221 @@ app.add_middleware(
 
 
 @app.get("/get_items")
-async def get_items(auth_data: Annotated[tuple[str], Depends(auth)]):
-    with orm.Session(engine) as session:
-        reading_item_Data = (
-            session.execute(
-                select(ReadingItemData)
-                .where(
-                    ReadingItemData.user_email == auth_data[0],
-                    ReadingItemData.archived == False,
-                    ReadingItemData.item.has(Item.type.in_(["read", "do"])),
-                )
-                .order_by(desc(ReadingItemData.item_order))
+async def get_items(
+    auth_data: Annotated[tuple[str], Depends(auth)],
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=500)] = 100,
+    order: Literal["queue", "model"] = "queue",
+):
+    # Summary fields only, the full content is served by /get_item/{uid}
+    query = items_query(auth_data[0], order, parse_items_cursor(cursor), limit)
+    async with AsyncSession(async_engine) as session:
+        items = [row._asdict() for row in await session.execute(query)]
+
+    next_cursor = None
+    if len(items) == limit:
+        key = "score" if order == "model" else "order"
+        next_cursor = encode_cursor([items[-1][key], items[-1]["uid"]])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def parse_items_cursor(cursor: str | None) -> tuple | None:
+    if cursor is None:
+        return None
+    try:
+        return tuple(decode_cursor(cursor, (int, float, type(None)), str))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def items_query(email: str, order: str, after: tuple | None, limit: int):
+    # Pages are keyed on (rank desc with nulls last, item_uid), the rank being
+    # the user's own order or the recommender's score (see ranking.py)
+    rank = ReadingItemData.score if order == "model" else ReadingItemData.item_order
+    query = (
+        select(
+            Item.uid,
+            Item.title,
+            Item.author,
+            Item.link,
+            Item.type,
+            Item.status,
+            ReadingItemData.item_order.label("order"),
+            ReadingItemData.score,
+            Item.created_at,
+        )
+        .join(Item, Item.uid == ReadingItemData.item_uid)
+        .where(
+            ReadingItemData.user_email == email,
+            ReadingItemData.archived == False,
+            Item.type.in_(["read", "do"]),
+        )
+        .order_by(desc(rank), ReadingItemData.item_uid)
+        .limit(limit)
+    )
+    if after is None:
+        return query
+    after_rank, after_uid = after
+    if after_rank is None:
+        return query.where(rank == None, ReadingItemData.item_uid > after_uid)
+    return query.where(
+        or_(
+            rank < after_rank,
+            and_(rank == after_rank, ReadingItemData.item_uid > after_uid),
+            rank == None,
+        )
+    )
+
+
+@app.get("/get_item/{uid}")
+async def get_item(uid: str, auth_data: Annotated[tuple[str], Depends(auth)]):
+    async with AsyncSession(async_engine) as session:
+        item = await session.scalar(
+            select(Item)
+            .where(Item.uid == uid, Item.user_email == auth_data[0])
+            .options(orm.joinedload(Item.article))
+        )
+        if item is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        return item.to_dict()
+
+
+async def fetch_rows(query) -> list:
+    async with AsyncSession(async_engine) as session:
+        return (await session.execute(query)).all()
+
+
+@app.get("/get_changes")
+async def get_changes(
+    request: Request,
+    auth_data: Annotated[tuple[str], Depends(auth)],
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 500,
+):
+    # Queue rows written since `cursor`, oldest first. Archived rows come back
+    # with `removed` so clients can drop them. Keep calling with the returned
+    # cursor until `has_more` is false.
+    async with AsyncSession(async_engine) as session:
+        latest_seq = await session.scalar(changes_version_query(auth_data[0]))
+        # Each page is its own representation, a client paging through with
+        # the ETag of the previous page mustn't be told nothing changed
+        etag = f'"{latest_seq or 0}:{limit}:{cursor or ""}"'
+        if not_modified(request, {"ETag": etag}):
+            return Response(status_code=304, headers={"ETag": etag})
+        query = changes_query(auth_data[0], parse_changes_cursor(cursor), limit)
+        changes = [row._asdict() for row in await session.execute(query)]
+
+    cursor = changes_page(changes, cursor)
+    return JSONResponse(
+        jsonable_encoder(
+            {"changes": changes, "cursor": cursor, "has_more": len(changes) == limit}
+        ),
+        headers={"ETag": etag},
+    )
+
+
+def changes_version_query(email: str):
+    return select(func.max(ReadingItemData.change_seq)).where(
+        ReadingItemData.user_email == email
+    )
+
+
+def parse_changes_cursor(cursor: str | None) -> tuple | None:
+    if cursor is None:
+        return None
+    try:
+        return tuple(decode_cursor(cursor, int, str))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def changes_query(email: str, after: tuple | None, limit: int):
+    query = (
+        select(
+            Item.uid,
+            Item.title,
+            Item.author,
+            Item.link,
+            Item.type,
+            Item.status,
+            ReadingItemData.item_order.label("order"),
+            ReadingItemData.archived,
+            ReadingItemData.done,
+            ReadingItemData.change_seq,
+            ReadingItemData.change_kind.label("kind"),
+            Item.created_at,
+        )
+        .join(Item, Item.uid == ReadingItemData.item_uid)
+        .where(
+            ReadingItemData.user_email == email,
+            ReadingItemData.change_seq != None,
+            Item.type.in_(store.READING_TYPES),
+        )
+        .order_by(ReadingItemData.change_seq, ReadingItemData.item_uid)
+        .limit(limit)
+    )
+    if after is not None:
+        after_seq, after_uid = after
+        query = query.where(
+            or_(
+                ReadingItemData.change_seq > after_seq,
+                and_(
+                    ReadingItemData.change_seq == after_seq,
+                    ReadingItemData.item_uid > after_uid,
+                ),
             )
-            .scalars()
-            .all()
         )
-        items = [x.item for x in reading_item_Data]
+    return query
+
+
+def changes_page(changes: list[dict], cursor: str | None) -> str | None:
+    # Marks removals and returns the cursor to continue after `changes`
+    for change in changes:
+        change["removed"] = change["archived"]
+    if changes:
+        return encode_cursor([changes[-1]["change_seq"], changes[-1]["uid"]])
+    return cursor
+
+
+async def change_events(request: Request, email: str, cursor: str | None):
+    # Same pages as /get_changes, one `changes` event each with the cursor as
+    # its id. All of a worker's streams share one watch on the counter that
+    # every queue write (any worker, or the ingester) bumps.
+    async with changes_watch.listen():
+        while not await request.is_disconnected():
+            seen = changes_watch.value
+            query = changes_query(
+                email, parse_changes_cursor(cursor), CHANGES_EVENT_BATCH
+            )
+            changes = [row._asdict() for row in await asyncio.shield(fetch_rows(query))]
+            if changes:
+                cursor = changes_page(changes, cursor)
+                yield sse_event(
+                    json.dumps(jsonable_encoder({"changes": changes})),
+                    event_id=cursor,
+                    event="changes",
+                )
+            if len(changes) < CHANGES_EVENT_BATCH:
+                if await changes_watch.wait(seen, SSE_HEARTBEAT) == seen:
+                    yield ": ping\n\n"
 
-    return {"items": [x.to_dict() for x in items]}
+
+@app.get("/get_changes/stream")
+async def get_changes_stream(
+    request: Request,
+    auth_data: Annotated[tuple[str], Depends(stream_auth)],
+    cursor: Optional[str] = None,
+    last_event_id: Annotated[Optional[str], Header()] = None,
+):
+    # Server-sent /get_changes: a reader opens it with the cursor of its last
+    # sync and is pushed every later queue change as it's written
+    cursor = last_event_id or cursor
+    parse_changes_cursor(cursor)
+    return StreamingResponse(
+        change_events(request, auth_data[0], cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 class AddItemBody(BaseModel):
@@ -87,63 +380,226 @@ class AddItemBody(BaseModel):
 
 @app.post("/add_item")
 async def add_item(body: AddItemBody, auth_data: Annotated[tuple[str], Depends(auth)]):
-    if not body.content and not body.title:
-        response = get_all_from_link(body.link)
-        body.title = response["title"]
-        body.author = response["siteName"]
-        html = response["html"]
-        md = markdownify.markdownify(html, heading_style="ATX")
-        body.content = md
+    if body.type not in store.META_TYPES and not body.content and not body.title:
+        # The article is extracted in the background, see extraction.py
+        async with AsyncSession(async_engine) as session:
+            items = await session.run_sync(
+                store.add_pending_items, auth_data[0], [body.link], body.type
+            )
+            await session.commit()
+        return JSONResponse(jsonable_encoder(items[0]), status_code=202)
 
     uid = generate_content_uid(
         [body.title or "", body.content, body.type, auth_data[0], body.link]
     )
     uiuid = generate_content_uid([body.title or "", body.content, body.type, body.link])
-    with orm.Session(engine) as session:
-        session.add(
-            Item(
-                uid=uid,
-                uiuid=uiuid,
-                title=body.title,
-                content=body.content,
-                link=body.link,
-                user_email=auth_data[0],
-                type=body.type,
-                author=body.author,
+    if body.type in store.RESONANCE_TYPES:
+        try:
+            store.event_value(body.type, body.content)
+        except (TypeError, ValueError):
+            raise HTTPException(
+                status_code=422, detail="Resonance content must be an integer"
             )
+    item = dict(
+        uid=uid,
+        uiuid=uiuid,
+        title=body.title,
+        content=body.content,
+        link=body.link,
+        type=body.type,
+        author=body.author,
+    )
+    async with AsyncSession(async_engine) as session:
+        item["uid"] = await session.run_sync(store.add_item, auth_data[0], item)
+        await session.commit()
+    return Item(
+        **item,
+        user_email=auth_data[0],
+        created_at=datetime.datetime.now(),
+    )
+
+
+class AddLinksBody(BaseModel):
+    links: List[str]
+    type: str = "read"
+
+
+@app.post("/add_links", status_code=202)
+async def add_links(
+    body: AddLinksBody, auth_data: Annotated[tuple[str], Depends(auth)]
+):
+    # Queues a batch of links at once, each is extracted like an /add_item
+    # without content. Returns their uids and statuses.
+    if not body.links or len(body.links) > MAX_LINKS_PER_REQUEST:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Send between 1 and {MAX_LINKS_PER_REQUEST} links",
         )
-        if body.type == "read":
-            session.add(
-                ReadingItemData(
-                    item_uid=uid,
-                    item_order=None,
-                    archived=False,
-                    user_email=auth_data[0],
-                    done=False,
-                )
-            )
-        if body.type == "do":
-            session.add(
-                ReadingItemData(
-                    item_uid=uid,
-                    item_order=None,
-                    archived=False,
-                    done=False,
-                    user_email=auth_data[0],
+    if body.type in store.META_TYPES:
+        raise HTTPException(status_code=422, detail="Links can't be meta events")
+    async with AsyncSession(async_engine) as session:
+        items = await session.run_sync(
+            store.add_pending_items, auth_data[0], body.links, body.type
+        )
+        await session.commit()
+    return {"items": items}
+
+
+@app.get("/get_item_status/{uid}")
+async def get_item_status(uid: str, auth_data: Annotated[tuple[str], Depends(auth)]):
+    async with AsyncSession(async_engine) as session:
+        row = (
+            await session.execute(
+                select(
+                    Item.uid,
+                    Item.status,
+                    ExtractionJob.attempts,
+                    ExtractionJob.last_error.label("error"),
                 )
+                .outerjoin(ExtractionJob, ExtractionJob.item_uid == Item.uid)
+                .where(Item.uid == uid, Item.user_email == auth_data[0])
             )
-        session.commit()
-    return Item(
-                uid=uid,
-                uiuid=uiuid,
-                title=body.title,
-                content=body.content,
-                link=body.link,
-                user_email=auth_data[0],
-                type=body.type,
-                author=body.author,
-                created_at=datetime.datetime.now(),
+        ).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return {**row._asdict(), "status": row.status or "ready"}
+
+
+SEARCH_MARK = ("<mark>", "</mark>")
+SEARCH_SNIPPET_TOKENS = 24
+# bm25 weights of title, summary and content, owner only filters
+SEARCH_WEIGHTS = (10, 4, 1, 0)
+
+
+def search_query(email: str, terms: str, *columns):
+    # The owner filter runs inside the index, other users' rows aren't scored.
+    # An owner phrase also matches longer addresses ending in it, so the owner
+    # is checked again on the rows found, the unary + keeps SQLite from
+    # driving the query from the user's items instead.
+    match = f"owner : {fts_phrase(email)} AND {{title summary content}} : ({terms})"
+    return (
+        select(*columns)
+        .select_from(items_fts)
+        .join(Item, literal_column("items.rowid") == items_fts.c.rowid)
+        .outerjoin(
+            ReadingItemData,
+            and_(
+                ReadingItemData.item_uid == Item.uid,
+                ReadingItemData.user_email == Item.user_email,
+            ),
+        )
+        .where(
+            items_fts.c.items_fts.op("MATCH")(match),
+            literal_column("+items.user_email") == email,
+        )
+    )
+
+
+@app.get("/search")
+async def search(
+    auth_data: Annotated[tuple[str], Depends(auth)],
+    q: Annotated[str, Query(min_length=1, max_length=500)],
+    type: Optional[str] = None,
+    archived: Optional[bool] = None,
+    done: Optional[bool] = None,
+    cursor: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+):
+    # Best matches first, with the matched words marked in the title and in a
+    # snippet of the content. Pages are offsets into the ranking.
+    terms = fts_query(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Nothing to search for")
+    offset = 0
+    if cursor is not None:
+        try:
+            (offset,) = decode_cursor(cursor, int)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if offset < 0:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    fts = literal_column("items_fts")
+    rank = func.bm25(fts, *SEARCH_WEIGHTS).label("rank")
+    ranked = (
+        search_query(auth_data[0], terms, items_fts.c.rowid, rank)
+        .order_by(rank)
+        .limit(limit)
+        .offset(offset)
+    )
+    if type is not None:
+        ranked = ranked.where(Item.type == type)
+    if archived is not None:
+        ranked = ranked.where(
+            func.coalesce(ReadingItemData.archived, False) == archived
+        )
+    if done is not None:
+        ranked = ranked.where(func.coalesce(ReadingItemData.done, False) == done)
+    async with AsyncSession(async_engine) as session:
+        ranks = dict((await session.execute(ranked)).all())
+        # Snippets read the content back, so they're only made for the page
+        rows = await session.execute(
+            search_query(
+                auth_data[0],
+                terms,
+                items_fts.c.rowid,
+                Item.uid,
+                Item.title,
+                Item.author,
+                Item.link,
+                Item.type,
+                Item.status,
+                ReadingItemData.archived,
+                ReadingItemData.done,
+                func.highlight(fts, 0, *SEARCH_MARK).label("title_highlight"),
+                func.snippet(fts, 2, *SEARCH_MARK, "…", SEARCH_SNIPPET_TOKENS).label(
+                    "snippet"
+                ),
+            ).where(items_fts.c.rowid.in_(list(ranks)))
+        )
+        items = sorted(
+            ({**row._asdict(), "score": -ranks[row.rowid]} for row in rows),
+            key=lambda item: -item["score"],
+        )
+    for item in items:
+        del item["rowid"]
+
+    next_cursor = None
+    if len(ranks) == limit:
+        next_cursor = encode_cursor([offset + limit])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+@app.get("/similar/{uid}")
+async def similar_items(
+    uid: str,
+    auth_data: Annotated[tuple[str], Depends(auth)],
+    k: Annotated[int, Query(ge=1, le=100)] = 10,
+):
+    # The user's items closest to this one by content, see similarity.py.
+    # Items the similarity process hasn't indexed yet have none.
+    async with AsyncSession(async_engine) as session:
+        uiuid = await session.scalar(
+            select(Item.uiuid).where(Item.uid == uid, Item.user_email == auth_data[0])
+        )
+        if uiuid is None:
+            raise HTTPException(status_code=404, detail="Item not found")
+        scores = await asyncio.to_thread(similarity.similar_to, uiuid)
+        rows = await session.execute(
+            select(
+                Item.uid, Item.uiuid, Item.title, Item.author, Item.link, Item.type
+            ).where(
+                Item.user_email == auth_data[0],
+                Item.uiuid.in_(list(scores)),
+                Item.uid != uid,
             )
+        )
+        items = sorted(
+            ({**row._asdict(), "similarity": scores[row.uiuid]} for row in rows),
+            key=lambda item: -item["similarity"],
+        )[:k]
+    for item in items:
+        del item["uiuid"]
+    return {"items": items}
 
 
 class CreateUserBody(BaseModel):
@@ -155,17 +611,18 @@ class CreateUserBody(BaseModel):
 async def create_user(
     body: CreateUserBody, auth_data: Annotated[tuple[str], Depends(auth)]
 ):
-    with orm.Session(engine) as session:
+    async with AsyncSession(async_engine) as session:
         new_user_auth_token = generate_auth_token()
         if auth_data[1]:
             session.add(
                 User(
                     email=body.email,
-                    auth_token=new_user_auth_token,
+                    auth_token_hash=hash_auth_token(new_user_auth_token),
                     is_admin=body.is_admin,
                 )
             )
-            session.commit()
+            await session.commit()
+            invalidate_auth(body.email)
             return {"email": body.email, "auth_token": new_user_auth_token}
 
 
@@ -178,19 +635,12 @@ class ArchiveItemBody(BaseModel):
 async def archive(
     body: ArchiveItemBody, auth_data: Annotated[tuple[str], Depends(auth)]
 ):
-    with orm.Session(engine) as session:
-        reading_item_data = (
-            session.execute(
-                select(ReadingItemData).where(
-                    ReadingItemData.item_uid == body.uid,
-                    ReadingItemData.user_email == auth_data[0],
-                )
-            )
-            .scalars()
-            .first()
-        )
-        reading_item_data.archived = body.archived
-        session.commit()
+    async with AsyncSession(async_engine) as session:
+        if not await session.run_sync(
+            store.set_flag, auth_data[0], body.uid, "_archive", body.archived
+        ):
+            raise HTTPException(status_code=404, detail="Item not found")
+        await session.commit()
     return {}
 
 
@@ -201,25 +651,22 @@ class DoneItemBody(BaseModel):
 
 @app.post("/done")
 async def done(body: DoneItemBody, auth_data: Annotated[tuple[str], Depends(auth)]):
-    with orm.Session(engine) as session:
-        reading_item_data = (
-            session.execute(
-                select(ReadingItemData).where(
-                    ReadingItemData.item_uid == body.uid,
-                    ReadingItemData.user_email == auth_data[0],
-                )
-            )
-            .scalars()
-            .first()
-        )
-        reading_item_data.done = body.done
-        session.commit()
+    async with AsyncSession(async_engine) as session:
+        if not await session.run_sync(
+            store.set_flag, auth_data[0], body.uid, "_done", body.done
+        ):
+            raise HTTPException(status_code=404, detail="Item not found")
+        await session.commit()
     return {}
 
 
 class OrderItemBody(BaseModel):
-    order: int
     uid: str
+    # Either an absolute rank, or the uid of the item to place this one directly
+    # before (above) or after (below)
+    order: Optional[int] = None
+    before: Optional[str] = None
+    after: Optional[str] = None
 
 
 class Order(BaseModel):
@@ -228,22 +675,21 @@ class Order(BaseModel):
 
 @app.post("/order")
 async def order(body: Order, auth_data: Annotated[tuple[str], Depends(auth)]):
-    print(body)
     for item in body.items:
-        with orm.Session(engine) as session:
-            reading_item_data = (
-                session.execute(
-                    select(ReadingItemData).where(
-                        ReadingItemData.item_uid == item.uid,
-                        ReadingItemData.user_email == auth_data[0],
-                    )
-                )
-                .scalars()
-                .first()
+        if sum(x is not None for x in [item.order, item.before, item.after]) != 1:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Item `{item.uid}` needs exactly one of order, before, after",
             )
-            reading_item_data.item_order = item.order
-            session.commit()
-        return {}
+    async with AsyncSession(async_engine) as session:
+        try:
+            ranks = await session.run_sync(
+                store.reorder, auth_data[0], [x.dict() for x in body.items]
+            )
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=str(e.args[0]))
+        await session.commit()
+    return {"items": [{"uid": uid, "order": rank} for uid, rank in ranks.items()]}
 
 
 class AddSourceBody(BaseModel):
@@ -256,7 +702,7 @@ async def add_source(
 ):
     source_type = detect_source_type(data.source)
     source_uid = generate_content_uid([data.source, source_type, auth_data[0]])
-    with orm.Session(engine) as session:
+    async with AsyncSession(async_engine) as session:
         session.add(
             Source(
                 uid=source_uid,
@@ -265,7 +711,7 @@ async def add_source(
                 user_email=auth_data[0],
             )
         )
-        session.commit()
+        await session.commit()
     return {"status": "ok"}
 
 
@@ -277,76 +723,237 @@ class DeleteSourceBody(BaseModel):
 async def delete_source(
     data: DeleteSourceBody, auth_data: Annotated[tuple[str], Depends(auth)]
 ):
-    with orm.Session(engine) as session:
-        source = (
-            session.execute(
-                select(Source).where(
-                    Source.source == data.source, Source.user_email == auth_data[0]
-                )
+    async with AsyncSession(async_engine) as session:
+        source = await session.scalar(
+            select(Source).where(
+                Source.source == data.source, Source.user_email == auth_data[0]
             )
-            .scalars()
-            .first()
         )
-        source.delete()
-        session.commit()
+        await session.delete(source)
+        await session.commit()
     return {"status": "ok"}
 
 
 @app.get("/get_sources")
 async def get_sources(auth_data: Annotated[tuple[str], Depends(auth)]):
-    with orm.Session(engine) as session:
-        sources = (
-            session.execute(select(Source).where(Source.user_email == auth_data[0]))
-            .scalars()
-            .all()
-        )
+    async with AsyncSession(async_engine) as session:
+        sources = (await session.scalars(sources_query(auth_data[0]))).all()
     return {"sources": [x.to_dict() for x in sources]}
 
 
+def sources_query(email: str):
+    return select(Source).where(Source.user_email == email)
+
+
+def feed_record(
+    item: Item, seq: int, active: bool, score: int, similar_to: str | None
+) -> dict:
+    if not active:
+        return {
+            "read": {"uid": item.uid, "link": item.link},
+            "seq": seq,
+            "removed": True,
+        }
+    return {
+        "read": item.to_dict(),
+        # Suggestions aren't the user's own resonance, peers mustn't take them so
+        "reasons": [
+            {"similar_to": similar_to, "score": score}
+            if similar_to
+            else {"resonance": score}
+        ],
+        "seq": seq,
+        "removed": False,
+    }
+
+
+def feed_version_query(user_email: str):
+    return (
+        select(FeedEntry.seq, FeedEntry.updated_at)
+        .where(FeedEntry.user_email == user_email)
+        .order_by(desc(FeedEntry.seq))
+        .limit(1)
+    )
+
+
+def feed_query(
+    user_email: str,
+    since: int | None,
+    until: int | None = None,
+    min_score: int | None = None,
+    top: int | None = None,
+):
+    # Active entries, or with `since` every entry that changed after it. The
+    # active ones can be narrowed to those scored at least `min_score` and/or
+    # the `top` N by score.
+    query = (
+        select(
+            Item, FeedEntry.seq, FeedEntry.active, FeedEntry.score, FeedEntry.similar_to
+        )
+        .join(FeedEntry, FeedEntry.item_uid == Item.uid)
+        .where(FeedEntry.user_email == user_email)
+        .order_by(FeedEntry.seq)
+        .options(orm.selectinload(Item.article))
+    )
+    if since is None:
+        query = query.where(FeedEntry.active == True)
+        if min_score is not None:
+            query = query.where(FeedEntry.score >= min_score)
+        if top is not None:
+            query = query.order_by(None).order_by(desc(FeedEntry.score)).limit(top)
+        return query
+    query = query.where(FeedEntry.seq > since)
+    if until is not None:
+        query = query.where(FeedEntry.seq <= until)
+    return query
+
+
+async def stream_feed(query, compress: bool):
+    # NDJSON, one record per line, flushed per batch of rows
+    encoder = zlib.compressobj(wbits=31) if compress else None
+    async with AsyncSession(async_engine) as session:
+        result = await session.stream(query.execution_options(yield_per=100))
+        async for rows in result.partitions():
+            chunk = "".join(
+                json.dumps(jsonable_encoder(feed_record(*row))) + "\n" for row in rows
+            ).encode("utf-8")
+            if encoder is None:
+                yield chunk
+            else:
+                yield encoder.compress(chunk) + encoder.flush(zlib.Z_SYNC_FLUSH)
+    if encoder is not None:
+        yield encoder.flush()
+
+
 @app.get("/get_feed/{user_email}")
-async def get_feed(user_email: str):
+async def get_feed(
+    user_email: str,
+    request: Request,
+    since: Optional[int] = None,
+    min_score: Optional[int] = None,
+    top: Annotated[Optional[int], Query(ge=1, le=1000)] = None,
+):
     # Rules based on which the user recommends stuff to other people @TODO (this endpoint can accept an optional email, so the user can recommend to specific individuals(?))
-    with orm.Session(engine) as session:
-        resonance_items = (
-            session.execute(
-                select(Item).where(
-                    Item.user_email == user_email, Item.type == "resonance"
-                )
-            )
-            .scalars()
-            .all()
-        )
-        send_item_uids = []
-        for resonance_item in resonance_items:
-            if int(resonance_item.content) > 80:
-                send_item_uids.append(resonance_item.link)
-
-        reading_items = (
-            session.execute(select(Item).where(Item.uid.in_(send_item_uids)))
-            .scalars()
-            .all()
+    # Entries are kept up to date by store.record_resonance, peers polling an
+    # unchanged feed only cost the version lookup. With `since` (the
+    # X-Feed-Cursor of an earlier response) only entries that changed after
+    # it are returned, removals included. Ask for application/x-ndjson to
+    # have them streamed, gzipped if accepted. A full feed can be narrowed to
+    # entries scored at least `min_score` and/or the `top` N by score.
+    async with AsyncSession(async_engine) as session:
+        latest = (await session.execute(feed_version_query(user_email))).first()
+    cursor = latest.seq if latest else 0
+    # Each representation has its own ETag, so caches keep them apart
+    stream = accepts(request.headers.get("accept"), "application/x-ndjson")
+    compress = stream and accepts(
+        request.headers.get("accept-encoding"), "gzip", wildcard="*"
+    )
+    etag = f"{cursor}-ndjson" if stream else str(cursor)
+    if compress:
+        etag += "-gzip"
+    headers = {
+        "ETag": f'"{etag}"',
+        "Vary": "Accept, Accept-Encoding",
+        "X-Feed-Cursor": str(cursor),
+    }
+    if latest is not None:
+        headers["Last-Modified"] = http_date(latest.updated_at)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+
+    query = feed_query(user_email, since, cursor, min_score, top)
+
+    if stream:
+        if compress:
+            headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(
+            stream_feed(query, compress),
+            media_type="application/x-ndjson",
+            headers=headers,
         )
-        resp = [{"read": x.to_dict(), "reasons": [{}]} for x in reading_items]
 
-    return resp
+    async with AsyncSession(async_engine) as session:
+        resp = [feed_record(*row) for row in await session.execute(query)]
+    return JSONResponse(jsonable_encoder(resp), headers=headers)
+
+
+async def feed_events(request: Request, user_email: str, cursor: int):
+    # One `entries` event per batch of changed entries, its data lines are the
+    # same records /get_feed streams as NDJSON and its id the resume cursor
+    async with feed_watch.listen():
+        while not await request.is_disconnected():
+            seen = feed_watch.value
+            # Shielded so a client hanging up mid-query doesn't cancel it and
+            # leave its pooled connection to be torn down
+            rows = await asyncio.shield(
+                fetch_rows(feed_query(user_email, cursor).limit(FEED_EVENT_BATCH))
+            )
+            if rows:
+                records = [feed_record(*row) for row in rows]
+                cursor = records[-1]["seq"]
+                yield sse_event(
+                    "\n".join(json.dumps(jsonable_encoder(x)) for x in records),
+                    event_id=cursor,
+                    event="entries",
+                )
+            if len(rows) < FEED_EVENT_BATCH:
+                if await feed_watch.wait(seen, SSE_HEARTBEAT) == seen:
+                    yield ": ping\n\n"
+
+
+@app.get("/get_feed/{user_email}/stream")
+async def get_feed_stream(
+    user_email: str,
+    request: Request,
+    since: Optional[int] = None,
+    last_event_id: Annotated[Optional[int], Header()] = None,
+):
+    # Server-sent events for peers, pushed as soon as entries change instead of
+    # being polled for. A reconnecting client resumes from Last-Event-ID.
+    cursor = last_event_id if last_event_id is not None else since or 0
+    return StreamingResponse(
+        feed_events(request, user_email, cursor),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.get("/get_mp3/{uid}")
 async def get_mp3(uid: str, auth_data: Annotated[tuple[str], Depends(auth)]):
-    with orm.Session(engine) as session:
+    async with AsyncSession(async_engine) as session:
         item = (
-            session.execute(
-                select(Item).where(Item.uid == uid, Item.user_email == auth_data[0])
+            await session.execute(
+                select(Item)
+                .where(Item.uid == uid, Item.user_email == auth_data[0])
+                .options(orm.selectinload(Item.article))
             )
-            .scalar()
-            .item()
+        ).scalar()
+    if item is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if item.status is not None:
+        raise HTTPException(
+            status_code=409, detail=f"Item is {item.status}, it has no content to read"
         )
-        mp3 = item_to_mp3(item.content, item.uiuid)
-    headers = {
-        "content-type": "audio/mpeg",
-        "content-disposition": "attachment; filename=data.mp3",
-    }
-    return Response(content=mp3, headers=headers)
+    # Streamed as the chunks are synthesized, see item_to_mp3.py
+    return StreamingResponse(
+        stream_mp3(item.full_content or "", item.uiuid),
+        media_type="audio/mpeg",
+        headers={"content-disposition": "attachment; filename=data.mp3"},
+    )
+
+
+@app.post("/stream_token")
+async def stream_token(
+    request: Request, auth_data: Annotated[tuple[str], Depends(auth)]
+):
+    # For /get_changes/stream?stream_token=..., valid for STREAM_TOKEN_TTL
+    # seconds; a reconnecting stream asks for a new one
+    if auth_data[0] is None:
+        raise HTTPException(status_code=400, detail="Streams belong to a user")
+    token = make_stream_token(
+        auth_data[0], hash_auth_token(request.headers["auth_token"]), STREAM_TOKEN_TTL
+    )
+    return {"stream_token": token, "expires_in": STREAM_TOKEN_TTL}
 
 
 @app.get("/auth_session")
@@ -365,8 +972,19 @@ async def startup():
 
 
 if __name__ == "__main__":
+    if not diffbot.DIFFBOT_TOKEN:
+        print("WM_DIFFBOT_TOKEN is not set, articles won't be extracted")
     p = multiprocessing.Process(target=refresh_data)
     p.start()
+    background = [p, multiprocessing.Process(target=run_extraction)]
+    background[-1].start()
+    background.append(multiprocessing.Process(target=run_ranking))
+    background[-1].start()
+    background.append(multiprocessing.Process(target=run_similarity))
+    background[-1].start()
+    if PREGENERATE_TOP:
+        background.append(multiprocessing.Process(target=pregenerate_audio))
+        background[-1].start()
     if len(sys.argv) > 1:
         port = int(sys.argv[1])
     else:
@@ -379,6 +997,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print("Stopping server...")
     finally:
-        # Ensure the background process is terminated when the server is stopped
-        p.terminate()
-        p.join()
+        # Ensure the background processes are terminated when the server is stopped
+        for p in background:
+            p.terminate()
+            p.join()
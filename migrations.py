@@ -0,0 +1,313 @@
+from sqlalchemy import Connection, Engine, MetaData, inspect
+from utils import RANK_GAP, RECOMMEND_THRESHOLD, hash_auth_token
+
+
+# SQLite schema migrations, tracked in `PRAGMA user_version`. MIGRATIONS[i]
+# upgrades a db from version i to i + 1. Tables that don't exist yet are left
+# to `create_all`, so a migration only has to deal with changed tables.
+
+
+def _rebuild_table(
+    conn: Connection, metadata: MetaData, name: str, exprs: dict | None = None
+):
+    # SQLite can't change column types or constraints in place: move the old
+    # table aside, create the new one and copy over the columns both have.
+    # `exprs` maps new column names to SQL computed from the old row.
+    exprs = exprs or {}
+    old = f"_old_{name}"
+    for index in inspect(conn).get_indexes(name):
+        conn.exec_driver_sql(f'DROP INDEX "{index["name"]}"')
+    conn.exec_driver_sql(f'ALTER TABLE "{name}" RENAME TO "{old}"')
+    table = metadata.tables[name]
+    table.create(conn)
+    old_columns = {x["name"] for x in inspect(conn).get_columns(old)}
+    columns = {
+        column.name: exprs.get(column.name, f'"{column.name}"')
+        for column in table.columns
+        if column.name in exprs or column.name in old_columns
+    }
+    # Rowids are kept, the search index refers to items by rowid
+    conn.exec_driver_sql(
+        f'INSERT INTO "{name}" (rowid, {", ".join(columns)}) '
+        f'SELECT rowid, {", ".join(columns.values())} FROM "{old}"'
+    )
+    # Triggers move with the renamed table and are dropped with it
+    conn.exec_driver_sql(f'DROP TABLE "{old}"')
+    if name == "items":
+        create_search_index(conn)
+
+
+def _typed_emails_hashed_tokens_and_indexes(conn: Connection, metadata: MetaData):
+    # From the original schema: user_email/item_uid were declared Integer,
+    # tokens were stored in plaintext, sources had no poll state and there
+    # were no secondary indexes
+    conn.connection.driver_connection.create_function(
+        "wm_hash_token", 1, hash_auth_token, deterministic=True
+    )
+    tables = inspect(conn).get_table_names()
+    if "users" in tables:
+        old_columns = {x["name"] for x in inspect(conn).get_columns("users")}
+        if "auth_token" in old_columns:
+            _rebuild_table(
+                conn,
+                metadata,
+                "users",
+                {"auth_token_hash": "wm_hash_token(auth_token)"},
+            )
+    if "items" in tables:
+        _rebuild_table(conn, metadata, "items")
+    if "sources" in tables:
+        old_columns = {x["name"] for x in inspect(conn).get_columns("sources")}
+        _rebuild_table(
+            conn,
+            metadata,
+            "sources",
+            {} if "failure_count" in old_columns else {"failure_count": "0"},
+        )
+    if "reading_item_data" in tables:
+        # Existing rows become the first change so clients can do a full sync
+        old_columns = {
+            x["name"] for x in inspect(conn).get_columns("reading_item_data")
+        }
+        _rebuild_table(
+            conn,
+            metadata,
+            "reading_item_data",
+            {
+                "change_seq": (
+                    "coalesce(change_seq, 1)" if "change_seq" in old_columns else "1"
+                )
+            },
+        )
+        conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO counters (name, value) VALUES ('changes', 1)"
+        )
+
+
+def _rank_unordered_items(conn: Connection, metadata: MetaData):
+    # Queue rows used to be inserted with a NULL item_order. Give them sparse
+    # ranks below the user's lowest one, in the order get_items showed them.
+    conn.exec_driver_sql(
+        f"""
+        WITH unranked AS (
+            SELECT item_uid, user_email, ROW_NUMBER() OVER (
+                PARTITION BY user_email ORDER BY item_uid
+            ) AS n
+            FROM reading_item_data WHERE item_order IS NULL
+        ), bottoms AS (
+            SELECT user_email, coalesce(min(item_order), 0) AS bottom
+            FROM reading_item_data GROUP BY user_email
+        )
+        UPDATE reading_item_data SET item_order = (
+            SELECT bottoms.bottom - unranked.n * {RANK_GAP}
+            FROM unranked JOIN bottoms USING (user_email)
+            WHERE unranked.item_uid = reading_item_data.item_uid
+            AND unranked.user_email = reading_item_data.user_email
+        )
+        WHERE item_order IS NULL
+        """
+    )
+
+
+def _materialize_feeds(conn: Connection, metadata: MetaData):
+    # Fill feed_entries from each user's latest resonance per item
+    conn.exec_driver_sql(
+        f"""
+        INSERT OR REPLACE INTO feed_entries
+            (user_email, item_uid, score, active, seq, updated_at)
+        SELECT user_email, link, CAST(content AS INTEGER), 1, 1, created_at
+        FROM items AS latest
+        WHERE type IN ('resonance', '_resonance')
+        AND CAST(content AS INTEGER) > {RECOMMEND_THRESHOLD}
+        AND created_at = (
+            SELECT max(created_at) FROM items
+            WHERE items.user_email = latest.user_email
+            AND items.link = latest.link
+            AND items.type IN ('resonance', '_resonance')
+        )
+        """
+    )
+    conn.exec_driver_sql(
+        "INSERT OR IGNORE INTO counters (name, value) VALUES ('feed', 1)"
+    )
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str):
+    # Nullable columns can be added in place. The table may already have it if
+    # an earlier migration rebuilt it from the current metadata.
+    if column not in {x["name"] for x in inspect(conn).get_columns(table)}:
+        conn.exec_driver_sql(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {ddl}')
+
+
+def _add_feed_cursor(conn: Connection, metadata: MetaData):
+    _add_column(conn, "sources", "feed_cursor", "INTEGER")
+
+
+def _add_change_kind(conn: Connection, metadata: MetaData):
+    _add_column(conn, "reading_item_data", "change_kind", "TEXT")
+    conn.exec_driver_sql(
+        """
+        UPDATE reading_item_data SET change_kind = CASE
+            WHEN archived THEN 'archived' WHEN done THEN 'done' ELSE 'added'
+        END
+        WHERE change_kind IS NULL
+        """
+    )
+
+
+def _create_indexes(conn: Connection, metadata: MetaData, name: str):
+    # create_all skips tables that exist, new indexes on them are made here
+    for index in metadata.tables[name].indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _typed_meta_events(conn: Connection, metadata: MetaData):
+    # Resonance/_done/_archive used to be stored as items, with the target uid
+    # as link and the value as text content
+    _create_indexes(conn, metadata, "feed_entries")
+    conn.exec_driver_sql(
+        """
+        INSERT OR REPLACE INTO item_events
+            (user_email, target_uid, type, value, created_at)
+        SELECT user_email, link, type, CASE
+            WHEN type IN ('resonance', '_resonance') THEN CAST(content AS INTEGER)
+            WHEN lower(trim(coalesce(content, ''))) IN ('0', 'false') THEN 0
+            ELSE 1
+        END, coalesce(created_at, CURRENT_TIMESTAMP)
+        FROM items
+        WHERE type IN ('resonance', '_resonance', '_done', '_archive')
+        ORDER BY created_at
+        """
+    )
+    conn.exec_driver_sql(
+        "DELETE FROM items WHERE type IN ('resonance', '_resonance', '_done', '_archive')"
+    )
+
+
+def _add_item_status(conn: Connection, metadata: MetaData):
+    _add_column(conn, "items", "status", "TEXT")
+
+
+# Full text search over items: an FTS5 index whose content is read back from a
+# view, so an article's markdown is stored once however many items share it.
+# `owner` is the user's email, matched in the query so only their rows are
+# scored. Triggers keep it in sync with every write to items, articles never
+# change once stored.
+SEARCH_INDEX_DDL = [
+    """
+    CREATE VIEW IF NOT EXISTS items_search AS
+    SELECT items.rowid AS item_rowid, items.title, items.summary,
+        coalesce(items.content, articles.content) AS content,
+        items.user_email AS owner
+    FROM items LEFT JOIN articles ON articles.uid = items.article_uid
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        title, summary, content, owner,
+        content='items_search', content_rowid='item_rowid',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+        INSERT INTO items_fts (rowid, title, summary, content, owner)
+        SELECT new.rowid, new.title, new.summary, coalesce(new.content,
+            (SELECT content FROM articles WHERE uid = new.article_uid)),
+            new.user_email;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+        INSERT INTO items_fts (items_fts, rowid, title, summary, content, owner)
+        SELECT 'delete', old.rowid, old.title, old.summary, coalesce(old.content,
+            (SELECT content FROM articles WHERE uid = old.article_uid)),
+            old.user_email;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS items_fts_update
+    AFTER UPDATE OF title, summary, content, article_uid, user_email ON items
+    BEGIN
+        INSERT INTO items_fts (items_fts, rowid, title, summary, content, owner)
+        SELECT 'delete', old.rowid, old.title, old.summary, coalesce(old.content,
+            (SELECT content FROM articles WHERE uid = old.article_uid)),
+            old.user_email;
+        INSERT INTO items_fts (rowid, title, summary, content, owner)
+        SELECT new.rowid, new.title, new.summary, coalesce(new.content,
+            (SELECT content FROM articles WHERE uid = new.article_uid)),
+            new.user_email;
+    END
+    """,
+]
+
+
+def create_search_index(conn: Connection):
+    # Also run whenever `items` is created, see models.py
+    if conn.dialect.name != "sqlite":
+        return
+    for ddl in SEARCH_INDEX_DDL:
+        conn.exec_driver_sql(ddl)
+
+
+def _add_search_index(conn: Connection, metadata: MetaData):
+    create_search_index(conn)
+    conn.exec_driver_sql("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+
+def _add_ranking_columns(conn: Connection, metadata: MetaData):
+    _add_column(conn, "items", "source", "TEXT")
+    _add_column(conn, "items", "peer_score", "INTEGER")
+    _add_column(conn, "reading_item_data", "score", "FLOAT")
+    _add_column(conn, "item_events", "seq", "INTEGER")
+    for name in ("items", "reading_item_data", "item_events"):
+        _create_indexes(conn, metadata, name)
+
+
+def _add_similar_feed_entries(conn: Connection, metadata: MetaData):
+    _add_column(conn, "feed_entries", "similar_to", "TEXT")
+    _create_indexes(conn, metadata, "items")
+    _create_indexes(conn, metadata, "feed_entries")
+
+
+def _add_article_metadata(conn: Connection, metadata: MetaData):
+    _add_column(conn, "articles", "title", "TEXT")
+    _add_column(conn, "articles", "author", "TEXT")
+
+
+MIGRATIONS = [
+    _typed_emails_hashed_tokens_and_indexes,
+    _rank_unordered_items,
+    _materialize_feeds,
+    _add_feed_cursor,
+    _add_change_kind,
+    _typed_meta_events,
+    _add_item_status,
+    _add_search_index,
+    _add_ranking_columns,
+    _add_similar_feed_entries,
+    _add_article_metadata,
+]
+
+
+def migrate(engine: Engine, metadata: MetaData):
+    if engine.dialect.name != "sqlite":
+        metadata.create_all(engine)
+        return
+    with engine.connect() as conn:
+        # pysqlite doesn't put DDL in a transaction by itself. IMMEDIATE also
+        # makes the other workers, which migrate on import too, wait for us.
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        # Keep foreign keys pointing at the table names while tables are rebuilt
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        if not inspect(conn).get_table_names():
+            version = len(MIGRATIONS)
+        # New tables first, migrations may rely on them existing
+        metadata.create_all(conn)
+        if version < len(MIGRATIONS):
+            print(f"Migrating db from schema version {version} to {len(MIGRATIONS)}")
+        for migration in MIGRATIONS[version:]:
+            migration(conn, metadata)
+        conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+        conn.commit()
@@ -5,16 +5,23 @@ from sqlalchemy import (
     String,
     Text,
     DateTime,
+    Float,
     Boolean,
     ForeignKey,
     PrimaryKeyConstraint,
     Identity,
+    Index,
     JSON,
     func,
     UniqueConstraint,
     Column,
     create_engine,
+    event,
+    table,
+    column,
 )
+from sqlalchemy.ext.asyncio import create_async_engine
+from migrations import create_search_index, migrate
 import os
 
 
@@ -29,12 +36,51 @@ class User(Base):
     __tablename__ = "users"
 
     email: orm.Mapped[str] = orm.mapped_column(Text, primary_key=True)
-    auth_token: orm.Mapped[str] = orm.mapped_column(Text)
+    # sha256 of the token, see utils.hash_auth_token; the plaintext is never stored
+    auth_token_hash: orm.Mapped[str] = orm.mapped_column(Text, unique=True, index=True)
     is_admin: orm.Mapped[bool] = orm.mapped_column(Boolean)
 
     created_at = Column(DateTime, default=func.now())
 
 
+class Article(Base):
+    __tablename__ = "articles"
+
+    # generate_content_uid of the normalized link, shared by all subscribers
+    uid: orm.Mapped[str] = orm.mapped_column(Text, primary_key=True)
+    link: orm.Mapped[str] = orm.mapped_column(Text)
+    content: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    # Given to items of the link added without them
+    title: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    author: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=func.now())
+
+
+class ArticleAlias(Base):
+    # A link whose article was found to duplicate a stored one, see dedup.py.
+    # Polls that meet the link again take it for that article.
+    __tablename__ = "article_aliases"
+
+    # generate_content_uid of the normalized link, like Article.uid
+    uid: orm.Mapped[str] = orm.mapped_column(Text, primary_key=True)
+    link: orm.Mapped[str] = orm.mapped_column(Text)
+    article_uid = Column(Text, ForeignKey("articles.uid"))
+
+    created_at = Column(DateTime, default=func.now())
+
+
+class ArticleFingerprint(Base):
+    # One band of an article's SimHash, see dedup.py
+    __tablename__ = "article_fingerprints"
+
+    band: orm.Mapped[int] = orm.mapped_column(Integer)
+    article_uid = Column(Text, ForeignKey("articles.uid"))
+    fingerprint: orm.Mapped[int] = orm.mapped_column(Integer)
+
+    __table_args__ = (PrimaryKeyConstraint("band", "article_uid"),)
+
+
 class Item(Base):
     __tablename__ = "items"
 
@@ -47,12 +93,41 @@ class Item(Base):
     link: orm.Mapped[str] = orm.mapped_column(Text)
     type: orm.Mapped[str] = orm.mapped_column(Text)
 
-    user_email = Column(Integer, ForeignKey("users.email"))
+    user_email = Column(Text, ForeignKey("users.email"))
     user = orm.relationship("User")
 
+    # Ingested items keep their body in the shared article store, content is None
+    article_uid = Column(Text, ForeignKey("articles.uid"), nullable=True)
+    article = orm.relationship("Article")
+
+    # "pending" while its article is being extracted, "failed" if that gave
+    # up, None once the item is complete. See extraction.py
+    status: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    # Feed the item was ingested from, None if it was added by hand
+    source: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    # Resonance of the peer whose spile feed recommended it
+    peer_score: orm.Mapped[int] = orm.mapped_column(Integer, nullable=True)
+
     created_at = Column(DateTime, default=func.now())
 
-    __table_args__ = (UniqueConstraint("link", "user_email"),)
+    __table_args__ = (
+        UniqueConstraint("link", "user_email"),
+        # get_feed: a user's items of one type (resonance)
+        Index("ix_items_user_type", "user_email", "type"),
+        # ranking: every user's copy of an article
+        Index("ix_items_article", "article_uid"),
+        # similarity: a user's copies of the nearest items
+        Index("ix_items_user_uiuid", "user_email", "uiuid"),
+    )
+
+    @property
+    def full_content(self):
+        if self.content is None and self.article is not None:
+            return self.article.content
+        return self.content
+
+    def to_dict(self):
+        return {**super().to_dict(), "content": self.full_content}
 
 
 class Source(Base):
@@ -62,34 +137,208 @@ class Source(Base):
     type: orm.Mapped[str] = orm.mapped_column(Text)
     uid: orm.Mapped[str] = orm.mapped_column(Text, primary_key=True)
 
-    user_email = Column(Integer, ForeignKey("users.email"))
+    user_email = Column(Text, ForeignKey("users.email"))
     user = orm.relationship("User")
 
+    # Poll scheduling state, see scheduler.py
+    etag: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    last_modified: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    content_hash: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    poll_interval: orm.Mapped[float] = orm.mapped_column(Float, nullable=True)
+    next_poll_at: orm.Mapped[datetime] = orm.mapped_column(DateTime, nullable=True)
+    last_polled_at: orm.Mapped[datetime] = orm.mapped_column(DateTime, nullable=True)
+    last_new_items_at: orm.Mapped[datetime] = orm.mapped_column(DateTime, nullable=True)
+    failure_count: orm.Mapped[int] = orm.mapped_column(Integer, default=0)
+    # Last X-Feed-Cursor consumed from a spile feed, see main.get_feed
+    feed_cursor: orm.Mapped[int] = orm.mapped_column(Integer, nullable=True)
+
     created_at = Column(DateTime, default=func.now())
 
-    __table_args__ = (UniqueConstraint("source", "user_email"),)
+    __table_args__ = (
+        UniqueConstraint("source", "user_email"),
+        Index("ix_sources_user", "user_email"),
+        # cron_consumer.due_sources
+        Index("ix_sources_next_poll_at", "next_poll_at"),
+    )
 
 
 class ReadingItemData(Base):
     __tablename__ = "reading_item_data"
 
-    item_uid: orm.Mapped[str] = orm.mapped_column(Text)
     item_order: orm.Mapped[int] = orm.mapped_column(Integer, nullable=True)
     archived: orm.Mapped[bool] = orm.mapped_column(Boolean)
     done: orm.Mapped[bool] = orm.mapped_column(Boolean)
+    # Value of the "changes" counter when the row was last written, see /get_changes
+    change_seq: orm.Mapped[int] = orm.mapped_column(Integer, nullable=True)
+    # What that write was: added, extracted, archived, unarchived, done, undone,
+    # reordered
+    change_kind: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    # Recommender score, higher first, None until ranked. See ranking.py
+    score: orm.Mapped[float] = orm.mapped_column(Float, nullable=True)
 
-    user_email = Column(Integer, ForeignKey("users.email"))
+    user_email = Column(Text, ForeignKey("users.email"))
     user = orm.relationship("User")
 
-    item_uid = Column(Integer, ForeignKey("items.uid"))
+    item_uid = Column(Text, ForeignKey("items.uid"))
+    item = orm.relationship("Item")
+
+    __table_args__ = (
+        PrimaryKeyConstraint("item_uid", "user_email"),
+        Index("ix_reading_item_data_changes", "user_email", "change_seq", "item_uid"),
+    )
+
+
+# The FTS5 index over items isn't part of the metadata, it's created with the
+# table. Queries go through these columns.
+event.listen(
+    Item.__table__, "after_create", lambda target, conn, **kw: create_search_index(conn)
+)
+items_fts = table(
+    "items_fts",
+    column("rowid", Integer),
+    column("items_fts"),
+)
+
+
+# get_items: a user's queue, ordered like the keyset pagination
+Index(
+    "ix_reading_item_data_queue",
+    ReadingItemData.user_email,
+    ReadingItemData.archived,
+    ReadingItemData.item_order.desc(),
+    ReadingItemData.item_uid,
+)
+# get_items?order=model
+Index(
+    "ix_reading_item_data_model",
+    ReadingItemData.user_email,
+    ReadingItemData.archived,
+    ReadingItemData.score.desc(),
+    ReadingItemData.item_uid,
+)
+# ranking: rows that were never scored
+Index(
+    "ix_reading_item_data_unscored",
+    ReadingItemData.item_uid,
+    sqlite_where=ReadingItemData.score == None,
+)
+
+
+class FeedEntry(Base):
+    # Materialized /get_feed: what each user currently recommends to peers,
+    # kept up to date as resonance events come in
+    __tablename__ = "feed_entries"
+
+    user_email = Column(Text, ForeignKey("users.email"))
+    item_uid = Column(Text, ForeignKey("items.uid"))
     item = orm.relationship("Item")
 
-    __table_args__ = (PrimaryKeyConstraint("item_uid", "user_email"),)
+    score: orm.Mapped[int] = orm.mapped_column(Integer)
+    active: orm.Mapped[bool] = orm.mapped_column(Boolean)
+    # Value of the "feed" counter when the entry last changed
+    seq: orm.Mapped[int] = orm.mapped_column(Integer)
+    updated_at: orm.Mapped[datetime] = orm.mapped_column(DateTime)
+    # Set on entries suggested for being like this highly rated item, see
+    # similarity.py. Rating the entry's own item clears it.
+    similar_to: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("user_email", "item_uid"),
+        Index("ix_feed_entries_user_seq", "user_email", "seq"),
+        Index("ix_feed_entries_similar_to", "similar_to"),
+        # get_feed's min_score/top
+        Index("ix_feed_entries_user_score", "user_email", "active", "score"),
+    )
+
+
+class ItemEvent(Base):
+    # Latest meta event (resonance score, done, archive) per user, target and
+    # type. `value` is the score, or 1/0 for the flags.
+    __tablename__ = "item_events"
+
+    user_email = Column(Text, ForeignKey("users.email"))
+    target_uid: orm.Mapped[str] = orm.mapped_column(Text)
+    type: orm.Mapped[str] = orm.mapped_column(Text)
+    value: orm.Mapped[int] = orm.mapped_column(Integer)
+    created_at: orm.Mapped[datetime] = orm.mapped_column(DateTime)
+    # Value of the "events" counter when the event was last written
+    seq: orm.Mapped[int] = orm.mapped_column(Integer, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("user_email", "target_uid", "type"),
+        # ranking: events written since it last ran
+        Index("ix_item_events_seq", "seq"),
+        # A user's events above/below a score, per-item averages and top-N
+        Index("ix_item_events_user_type", "user_email", "type", "value"),
+        Index("ix_item_events_target", "target_uid", "type", "value"),
+    )
+
+
+class ExtractionJob(Base):
+    # An item added without content, waiting for its article to be extracted.
+    # Rows are deleted once that succeeds.
+    __tablename__ = "extraction_jobs"
+
+    item_uid = Column(Text, ForeignKey("items.uid"), primary_key=True)
+    link: orm.Mapped[str] = orm.mapped_column(Text)
+    # pending, running or failed
+    status: orm.Mapped[str] = orm.mapped_column(Text)
+    attempts: orm.Mapped[int] = orm.mapped_column(Integer, default=0)
+    last_error: orm.Mapped[str] = orm.mapped_column(Text, nullable=True)
+    next_attempt_at: orm.Mapped[datetime] = orm.mapped_column(DateTime)
+
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        # extraction.claim_jobs
+        Index("ix_extraction_jobs_due", "status", "next_attempt_at"),
+    )
+
+
+class Counter(Base):
+    __tablename__ = "counters"
+
+    name: orm.Mapped[str] = orm.mapped_column(Text, primary_key=True)
+    value: orm.Mapped[int] = orm.mapped_column(Integer)
 
 
 db_url = os.environ.get(
     "WM_DB_URL", "sqlite:///" + str(os.path.join(os.getcwd(), "spile.db"))
 )
+# The request handlers use the async engine, the driver is swapped in for the url
+async_db_url = os.environ.get(
+    "WM_ASYNC_DB_URL", db_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+)
 print(f"Running on db url: {db_url}")
-engine = create_engine(db_url, echo=False)
-Base.metadata.create_all(engine)
+
+pool_options = dict(
+    pool_size=int(os.environ.get("WM_DB_POOL_SIZE", 5)),
+    max_overflow=int(os.environ.get("WM_DB_MAX_OVERFLOW", 10)),
+    pool_timeout=float(os.environ.get("WM_DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(os.environ.get("WM_DB_POOL_RECYCLE", -1)),
+)
+# WAL lets the api workers read while the ingestion process writes
+sqlite_pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": os.environ.get("WM_DB_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("WM_DB_BUSY_TIMEOUT", 5000)),
+    "mmap_size": int(os.environ.get("WM_DB_MMAP_SIZE", 256 * 1024 * 1024)),
+    # negative is KiB
+    "cache_size": int(os.environ.get("WM_DB_CACHE_SIZE", -64 * 1024)),
+    "temp_store": "MEMORY",
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+engine = create_engine(db_url, echo=False, **pool_options)
+async_engine = create_async_engine(async_db_url, echo=False, **pool_options)
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+migrate(engine, Base.metadata)
@@ -0,0 +1,67 @@
+from contextlib import asynccontextmanager
+from models import Counter, async_engine
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import os
+
+WATCH_INTERVAL = float(os.environ.get("WM_WATCH_INTERVAL", 0.25))
+SSE_HEARTBEAT = float(os.environ.get("WM_SSE_HEARTBEAT", 15))
+
+
+class CounterWatch:
+    # Follows one row of the counters table for long-lived streams. Writes can
+    # come from any worker, so each worker runs a single poller on the counter
+    # (a primary key lookup) while it has listeners, instead of every stream
+    # querying its own tables.
+    def __init__(self, name: str, interval: float = WATCH_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.value = None
+        self.listeners = 0
+        self.task = None
+        self.moved = asyncio.Event()
+
+    async def _poll(self):
+        while self.listeners:
+            async with AsyncSession(async_engine) as session:
+                value = (
+                    await session.execute(
+                        select(Counter.value).where(Counter.name == self.name)
+                    )
+                ).scalar() or 0
+            if value != self.value:
+                self.value = value
+                self.moved.set()
+                self.moved = asyncio.Event()
+            await asyncio.sleep(self.interval)
+        self.task = None
+
+    @asynccontextmanager
+    async def listen(self):
+        self.listeners += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._poll())
+        try:
+            yield self
+        finally:
+            self.listeners -= 1
+
+    async def wait(self, seen: int | None, timeout: float) -> int | None:
+        # Returns once the counter differs from `seen`, or after `timeout`
+        if self.value is None or self.value == seen:
+            try:
+                await asyncio.wait_for(self.moved.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.value
+
+
+def sse_event(data: str, event_id: int | None = None, event: str | None = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.splitlines())
+    return "\n".join(lines) + "\n\n"
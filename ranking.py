@@ -0,0 +1,227 @@
+from collections import defaultdict
+from datetime import datetime
+from models import Counter, Item, ItemEvent, ReadingItemData, engine
+from sqlalchemy import bindparam, orm, select, update
+from urllib.parse import urlsplit
+import math
+import numpy as np
+import os
+import store
+import time
+
+
+# Scores every queue row for get_items?order=model, from
+# - peer resonance with its article: other users of this node who rated it,
+#   and the peer whose spile feed recommended it
+# - the user's affinity for its source, learned from their own resonance
+#   with earlier items of that feed (or site, for items added by hand)
+# - its type and age
+# Age enters as created_at / tau, an exponential decay in log space that is
+# the same for every row at any moment: scores don't go stale as time passes,
+# so only rows whose signals changed are ever rescored.
+RANK_BATCH = int(os.environ.get("WM_RANK_BATCH", 5000))
+RANK_INTERVAL = float(os.environ.get("WM_RANK_INTERVAL", 2))
+RANK_HALF_LIFE = float(os.environ.get("WM_RANK_HALF_LIFE_HOURS", 72)) * 3600
+PEER_WEIGHT = float(os.environ.get("WM_RANK_PEER_WEIGHT", 2))
+AFFINITY_WEIGHT = float(os.environ.get("WM_RANK_AFFINITY_WEIGHT", 1.5))
+# Pseudo-counts of neutral ratings, so one rating doesn't decide everything
+PEER_PRIOR = 2
+AFFINITY_PRIOR = 3
+TYPE_BOOST = np.array([0.0, 0.5])
+TYPE_CODES = {"read": 0, "do": 1}
+# Ages are counted from here, keeps the scores small
+EPOCH = datetime(2024, 1, 1)
+# Counter row holding the last item_events seq that was taken into account
+CURSOR = "ranked_events"
+
+
+def score_batch(
+    types: np.ndarray,
+    created: np.ndarray,
+    affinity: np.ndarray,
+    peer_sum: np.ndarray,
+    peer_count: np.ndarray,
+) -> np.ndarray:
+    # types: TYPE_CODES, created: seconds since EPOCH, affinity: -1 to 1,
+    # peer_sum/peer_count: resonance (0 to 100) summed over the peers
+    peer = (peer_sum - 50 * peer_count) / 50 / (peer_count + PEER_PRIOR)
+    return (
+        PEER_WEIGHT * peer
+        + AFFINITY_WEIGHT * affinity
+        + TYPE_BOOST[types]
+        + created * (math.log(2) / RANK_HALF_LIFE)
+    )
+
+
+def source_key(source: str | None, link: str | None) -> str:
+    return source or urlsplit(link or "").netloc.lower()
+
+
+def affinities(session: orm.Session, emails: list[str]) -> dict:
+    # email -> source key -> mean resonance, from -1 to 1
+    totals = defaultdict(lambda: defaultdict(lambda: [0.0, 0]))
+    rows = session.execute(
+        select(ItemEvent.user_email, ItemEvent.value, Item.source, Item.link)
+        .join(Item, Item.uid == ItemEvent.target_uid)
+        .where(
+            ItemEvent.user_email.in_(emails),
+            ItemEvent.type.in_(store.RESONANCE_TYPES),
+        )
+    )
+    for email, value, source, link in rows:
+        total = totals[email][source_key(source, link)]
+        total[0] += (value - 50) / 50
+        total[1] += 1
+    return {
+        email: {key: x / (n + AFFINITY_PRIOR) for key, (x, n) in keys.items()}
+        for email, keys in totals.items()
+    }
+
+
+def peer_ratings(session: orm.Session, article_uids: list[str]) -> dict:
+    # article uid -> {email: resonance} over every user's copy of the article
+    ratings = defaultdict(dict)
+    for article_uid, email, value in session.execute(peer_ratings_query(article_uids)):
+        ratings[article_uid][email] = value
+    return ratings
+
+
+def peer_ratings_query(article_uids: list[str]):
+    return (
+        select(Item.article_uid, ItemEvent.user_email, ItemEvent.value)
+        .join(ItemEvent, ItemEvent.target_uid == Item.uid)
+        .where(
+            Item.article_uid.in_(article_uids),
+            ItemEvent.type.in_(store.RESONANCE_TYPES),
+        )
+    )
+
+
+def queue_rows(session: orm.Session, *where, limit: int | None = None) -> list:
+    return session.execute(
+        select(
+            ReadingItemData.user_email,
+            ReadingItemData.item_uid,
+            Item.type,
+            Item.created_at,
+            Item.source,
+            Item.link,
+            Item.article_uid,
+            Item.peer_score,
+        )
+        .join(Item, Item.uid == ReadingItemData.item_uid)
+        .where(*where)
+        .limit(limit)
+    ).all()
+
+
+def rescore(session: orm.Session, rows: list) -> int:
+    if not rows:
+        return 0
+    affinity = affinities(session, list({x.user_email for x in rows}))
+    ratings = peer_ratings(session, list({x.article_uid for x in rows} - {None}))
+    peer_sum = np.zeros(len(rows))
+    peer_count = np.zeros(len(rows))
+    for i, row in enumerate(rows):
+        others = [
+            v
+            for k, v in ratings.get(row.article_uid, {}).items()
+            if k != row.user_email
+        ]
+        if row.peer_score is not None:
+            others.append(row.peer_score)
+        peer_sum[i] = sum(others)
+        peer_count[i] = len(others)
+    scores = score_batch(
+        np.fromiter((TYPE_CODES.get(x.type, 0) for x in rows), np.intp, len(rows)),
+        np.fromiter(
+            (((x.created_at or EPOCH) - EPOCH).total_seconds() for x in rows),
+            float,
+            len(rows),
+        ),
+        np.fromiter(
+            (
+                affinity.get(x.user_email, {}).get(source_key(x.source, x.link), 0.0)
+                for x in rows
+            ),
+            float,
+            len(rows),
+        ),
+        peer_sum,
+        peer_count,
+    )
+    table = ReadingItemData.__table__
+    session.execute(
+        update(table)
+        .where(
+            table.c.item_uid == bindparam("uid"),
+            table.c.user_email == bindparam("email"),
+        )
+        .values(score=bindparam("score")),
+        [
+            {"uid": row.item_uid, "email": row.user_email, "score": float(score)}
+            for row, score in zip(rows, scores)
+        ],
+    )
+    return len(rows)
+
+
+def rank_unscored(session: orm.Session) -> int:
+    # New queue rows, at most RANK_BATCH
+    rows = queue_rows(session, ReadingItemData.score == None, limit=RANK_BATCH)
+    return rescore(session, rows)
+
+
+def events_query(after: int):
+    return (
+        select(ItemEvent.seq, ItemEvent.type, ItemEvent.user_email, Item.article_uid)
+        .outerjoin(Item, Item.uid == ItemEvent.target_uid)
+        .where(ItemEvent.seq > after)
+        .order_by(ItemEvent.seq)
+        .limit(RANK_BATCH)
+    )
+
+
+def rank_changed(session: orm.Session) -> int:
+    # Unread rows whose signals moved with the resonance events written since
+    # the last call: the rater's whole queue (their affinities) and every
+    # other user's copy of the rated article (its peer resonance)
+    cursor = session.get(Counter, CURSOR)
+    if cursor is None:
+        cursor = Counter(name=CURSOR, value=0)
+        session.add(cursor)
+    events = session.execute(events_query(cursor.value)).all()
+    if not events:
+        return 0
+    cursor.value = events[-1].seq
+    resonance = [x for x in events if x.type in store.RESONANCE_TYPES]
+    emails = list({x.user_email for x in resonance})
+    articles = list({x.article_uid for x in resonance} - {None})
+    unread = (ReadingItemData.archived == False, ReadingItemData.done == False)
+    rescored = 0
+    for i in range(0, len(emails), 100):
+        rows = queue_rows(
+            session, ReadingItemData.user_email.in_(emails[i : i + 100]), *unread
+        )
+        rescored += rescore(session, rows)
+    for i in range(0, len(articles), 500):
+        rows = queue_rows(session, Item.article_uid.in_(articles[i : i + 500]), *unread)
+        rescored += rescore(session, rows)
+    return rescored
+
+
+def run_ranking():
+    while True:
+        started = time.perf_counter()
+        with orm.Session(engine) as session:
+            ranked = rank_unscored(session)
+            session.commit()
+            rescored = rank_changed(session)
+            session.commit()
+        if ranked or rescored:
+            print(
+                f"Ranked {ranked} new and rescored {rescored} queue rows "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+        if not ranked and not rescored:
+            time.sleep(RANK_INTERVAL)
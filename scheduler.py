@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+from models import Source
+import os
+import random
+
+
+# (min, max) seconds between polls of a healthy source. The interval moves
+# between them depending on how often the feed actually publishes.
+POLL_INTERVALS = {
+    "rss": (
+        float(os.environ.get("WM_RSS_MIN_INTERVAL", 60)),
+        float(os.environ.get("WM_RSS_MAX_INTERVAL", 6 * 60 * 60)),
+    ),
+    "spile": (
+        float(os.environ.get("WM_SPILE_MIN_INTERVAL", 1)),
+        float(os.environ.get("WM_SPILE_MAX_INTERVAL", 2)),
+    ),
+}
+MAX_BACKOFF = float(os.environ.get("WM_MAX_BACKOFF", 24 * 60 * 60))
+IDLE_GROWTH = 1.5
+
+
+def poll_bounds(source_type: str) -> tuple[float, float]:
+    return POLL_INTERVALS.get(source_type, POLL_INTERVALS["rss"])
+
+
+def conditional_headers(sources: list[Source]) -> dict:
+    # A shared fetch may only be conditional if every subscriber has the same copy
+    if len({(x.etag, x.last_modified, x.content_hash) for x in sources}) != 1:
+        return {}
+    source = sources[0]
+    headers = {}
+    if source.etag:
+        headers["If-None-Match"] = source.etag
+    if source.last_modified:
+        headers["If-Modified-Since"] = source.last_modified
+    return headers
+
+
+def feed_params(sources: list[Source]) -> dict:
+    # Spile feeds can send just the entries that changed after a cursor, as
+    # long as every subscriber has consumed up to one
+    if any(x.type != "spile" or x.feed_cursor is None for x in sources):
+        return {}
+    return {"since": min(x.feed_cursor for x in sources)}
+
+
+def _jitter(seconds: float) -> timedelta:
+    # Spread polls out so sources added together don't stay in lockstep
+    return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+# Both record_* helpers return the Source columns to write back for the poll
+def record_poll(
+    source: Source,
+    now: datetime,
+    new_items: int,
+    etag: str | None = None,
+    last_modified: str | None = None,
+    content_hash: str | None = None,
+    feed_cursor: int | None = None,
+) -> dict:
+    low, high = poll_bounds(source.type)
+    interval = source.poll_interval or low
+    last_new_items_at = source.last_new_items_at
+    if new_items:
+        # Aim for roughly one poll per published item
+        if last_new_items_at is not None:
+            seconds_per_item = (now - last_new_items_at).total_seconds() / new_items
+        else:
+            seconds_per_item = low
+        interval = (interval + seconds_per_item) / 2
+        last_new_items_at = now
+    else:
+        interval *= IDLE_GROWTH
+    interval = min(max(interval, low), high)
+
+    state = {
+        "uid": source.uid,
+        "poll_interval": interval,
+        "next_poll_at": now + _jitter(interval),
+        "last_polled_at": now,
+        "last_new_items_at": last_new_items_at,
+        "failure_count": 0,
+    }
+    # A 304 carries no body, keep the validators of the copy we already have
+    if content_hash is not None:
+        state.update(etag=etag, last_modified=last_modified, content_hash=content_hash)
+    if feed_cursor is not None:
+        state["feed_cursor"] = feed_cursor
+    return state
+
+
+def record_failure(source: Source, now: datetime) -> dict:
+    low, _ = poll_bounds(source.type)
+    failure_count = (source.failure_count or 0) + 1
+    backoff = min(MAX_BACKOFF, max(low, 30) * 2 ** (failure_count - 1))
+    return {
+        "uid": source.uid,
+        "next_poll_at": now + _jitter(backoff),
+        "last_polled_at": now,
+        "failure_count": failure_count,
+    }
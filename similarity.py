@@ -0,0 +1,310 @@
+from collections import defaultdict
+from models import Article, Counter, Item, ItemEvent, engine
+from scipy import sparse
+from sqlalchemy import func, literal_column, orm, select
+from utils import RECOMMEND_THRESHOLD
+import numpy as np
+import os
+import re
+import store
+import threading
+import time
+import zlib
+
+
+# Content-based similarity between items: every distinct item (by uiuid) is a
+# row of hashed TF-IDF features over its title, summary and markdown, pruned
+# to its strongest terms and L2 normalized, so a dot product is the cosine.
+# The similarity process appends new items in batches and saves the matrix
+# to SIM_INDEX_PATH, which the API workers reload in the background when it
+# changes.
+SIM_INDEX_PATH = os.environ.get("WM_SIM_INDEX_PATH", "similarity_index.npz")
+SIM_FEATURES = 1 << 20
+SIM_TERMS = int(os.environ.get("WM_SIM_TERMS", 128))
+SIM_BATCH = int(os.environ.get("WM_SIM_BATCH", 1000))
+SIM_INTERVAL = float(os.environ.get("WM_SIM_INTERVAL", 2))
+SIM_SAVE_INTERVAL = float(os.environ.get("WM_SIM_SAVE_INTERVAL", 10))
+# Nearest rows looked at, before narrowing them down to one user's items
+SIM_CANDIDATES = 500
+# Items rated above RECOMMEND_THRESHOLD add up to SIM_FEED_K of the user's
+# unrated items at least SIM_FEED_MIN similar to them to the feed
+SIM_FEED_K = int(os.environ.get("WM_SIM_FEED_K", 3))
+SIM_FEED_MIN = float(os.environ.get("WM_SIM_FEED_MIN", 0.3))
+FIELD_WEIGHTS = (3, 2, 1)
+TOKEN = re.compile(r"[^\W_]{2,}")
+# Counter row holding the last item_events seq that was looked at
+CURSOR = "similar_events"
+
+
+def features(*fields: str | None) -> tuple[np.ndarray, np.ndarray]:
+    # (feature ids, sublinear term frequencies) of title, summary and content
+    counts = defaultdict(float)
+    for text, weight in zip(fields, FIELD_WEIGHTS):
+        for token in TOKEN.findall((text or "").lower()):
+            counts[token] += weight
+    ids = np.fromiter(
+        (zlib.crc32(x.encode()) & (SIM_FEATURES - 1) for x in counts),
+        np.int32,
+        len(counts),
+    )
+    tf = 1 + np.log(np.fromiter(counts.values(), np.float32, len(counts)))
+    # Hash collisions add up
+    ids, inverse = np.unique(ids, return_inverse=True)
+    return ids, np.bincount(inverse, tf).astype(np.float32)
+
+
+class SimilarityIndex:
+    def __init__(self):
+        self.keys = []
+        self.rows = {}
+        self.matrix = sparse.csr_matrix((0, SIM_FEATURES), dtype=np.float32)
+        self.df = np.zeros(SIM_FEATURES, np.int32)
+        # Last items.rowid taken in, and items whose article is still pending
+        self.item_cursor = 0
+        self.waiting = set()
+        # Column major copy for queries, made on first use
+        self.postings = None
+        self.mtime = None
+
+    def add(self, docs: list[tuple[str, str | None, str | None, str | None]]):
+        # (uiuid, title, summary, content). IDF is taken as of when a row is
+        # added, later rows see the grown corpus.
+        indptr, indices, data, keys = [0], [], [], []
+        for key, *fields in docs:
+            if key in self.rows or key in keys:
+                continue
+            ids, tf = features(*fields)
+            if not len(ids):
+                continue
+            self.df[ids] += 1
+            n = len(self.keys) + len(keys) + 1
+            weights = tf * (np.log((1 + n) / (1 + self.df[ids])) + 1)
+            if len(ids) > SIM_TERMS:
+                strongest = np.sort(np.argpartition(weights, -SIM_TERMS)[-SIM_TERMS:])
+                ids, weights = ids[strongest], weights[strongest]
+            indices.append(ids)
+            data.append(weights / np.linalg.norm(weights))
+            indptr.append(indptr[-1] + len(ids))
+            keys.append(key)
+        if not keys:
+            return 0
+        batch = sparse.csr_matrix(
+            (np.concatenate(data), np.concatenate(indices), indptr),
+            shape=(len(keys), SIM_FEATURES),
+            dtype=np.float32,
+        )
+        self.matrix = sparse.vstack([self.matrix, batch], format="csr")
+        for key in keys:
+            self.rows[key] = len(self.keys)
+            self.keys.append(key)
+        self.postings = None
+        return len(keys)
+
+    def similar(self, key: str, limit: int = SIM_CANDIDATES) -> list[tuple[str, float]]:
+        # Nearest rows to `key` by cosine, best first
+        row = self.rows.get(key)
+        if row is None:
+            return []
+        if self.postings is None:
+            self.postings = self.matrix.tocsc()
+        query = self.matrix[row]
+        # Only the postings of the query's own terms are read
+        scores = self.postings[:, query.indices] @ query.data
+        scores[row] = 0
+        limit = min(limit, len(scores) - 1)
+        if limit <= 0:
+            return []
+        top = np.argpartition(scores, -limit)[-limit:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.keys[i], float(scores[i])) for i in top if scores[i] > 0]
+
+    def save(self, path: str):
+        # With the column major copy, so loading it doesn't have to build one
+        if self.postings is None:
+            self.postings = self.matrix.tocsc()
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as fp:
+            np.savez(
+                fp,
+                data=self.matrix.data,
+                indices=self.matrix.indices,
+                indptr=self.matrix.indptr,
+                postings_data=self.postings.data,
+                postings_indices=self.postings.indices,
+                postings_indptr=self.postings.indptr,
+                keys=np.array(self.keys, dtype=str),
+                df=self.df,
+                item_cursor=np.array([self.item_cursor]),
+                waiting=np.array(sorted(self.waiting), dtype=np.int64),
+            )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SimilarityIndex":
+        index = cls()
+        with np.load(path) as saved:
+            index.keys = saved["keys"].tolist()
+            index.matrix = sparse.csr_matrix(
+                (saved["data"], saved["indices"], saved["indptr"]),
+                shape=(len(index.keys), SIM_FEATURES),
+            )
+            if "postings_indptr" in saved.files:
+                index.postings = sparse.csc_matrix(
+                    (
+                        saved["postings_data"],
+                        saved["postings_indices"],
+                        saved["postings_indptr"],
+                    ),
+                    shape=index.matrix.shape,
+                )
+            index.df = saved["df"]
+            index.item_cursor = int(saved["item_cursor"][0])
+            index.waiting = set(saved["waiting"].tolist())
+        index.rows = {key: i for i, key in enumerate(index.keys)}
+        return index
+
+
+_shared = None
+_reloading = threading.Lock()
+
+
+def reload_shared(mtime: float):
+    global _shared
+    try:
+        index = SimilarityIndex.load(SIM_INDEX_PATH)
+        index.mtime = mtime
+        _shared = index
+    finally:
+        _reloading.release()
+
+
+def shared_index() -> SimilarityIndex | None:
+    # The index as last saved by the similarity process. When it changes it's
+    # reloaded on a thread of its own and swapped in once ready, requests keep
+    # using the previous one meanwhile (none before the first load).
+    try:
+        mtime = os.stat(SIM_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+    if _shared is None or _shared.mtime != mtime:
+        if _reloading.acquire(blocking=False):
+            threading.Thread(target=reload_shared, args=(mtime,), daemon=True).start()
+    return _shared
+
+
+def similar_to(uiuid: str) -> dict[str, float]:
+    index = shared_index()
+    return dict(index.similar(uiuid)) if index is not None else {}
+
+
+def index_new_items(session: orm.Session, index: SimilarityIndex) -> int:
+    rowid = literal_column("items.rowid")
+    columns = (
+        rowid.label("rowid"),
+        Item.uiuid,
+        Item.title,
+        Item.summary,
+        Item.status,
+        func.coalesce(Item.content, Article.content).label("content"),
+    )
+    query = select(*columns).outerjoin(Article, Article.uid == Item.article_uid)
+    rows = session.execute(
+        query.where(rowid > index.item_cursor).order_by(rowid).limit(SIM_BATCH)
+    ).all()
+    if index.waiting:
+        rows += session.execute(query.where(rowid.in_(index.waiting))).all()
+    docs = []
+    for row in rows:
+        index.item_cursor = max(index.item_cursor, row.rowid)
+        if row.status == "pending":
+            index.waiting.add(row.rowid)
+            continue
+        index.waiting.discard(row.rowid)
+        docs.append((row.uiuid, row.title, row.summary, row.content))
+    index.add(docs)
+    return len(rows)
+
+
+def suggest_similar(session: orm.Session, index: SimilarityIndex) -> int:
+    # Adds the user's items most like the ones they just rated highly to their
+    # feed, see store.suggest_similar
+    cursor = session.get(Counter, CURSOR)
+    if cursor is None:
+        cursor = Counter(name=CURSOR, value=0)
+        session.add(cursor)
+    events = session.scalars(
+        select(ItemEvent)
+        .where(ItemEvent.seq > cursor.value)
+        .order_by(ItemEvent.seq)
+        .limit(SIM_BATCH)
+    ).all()
+    if not events:
+        return 0
+    cursor.value = events[-1].seq
+    suggested = 0
+    for event in events:
+        if event.type not in store.RESONANCE_TYPES:
+            continue
+        if event.value <= RECOMMEND_THRESHOLD:
+            continue
+        target = session.get(Item, event.target_uid)
+        if target is None:
+            continue
+        scores = dict(index.similar(target.uiuid))
+        mine = session.execute(
+            select(Item.uid, Item.uiuid).where(
+                Item.user_email == event.user_email,
+                Item.uiuid.in_(list(scores)),
+                Item.uid != target.uid,
+            )
+        ).all()
+        rated = set(
+            session.execute(
+                select(ItemEvent.target_uid).where(
+                    ItemEvent.user_email == event.user_email,
+                    ItemEvent.target_uid.in_([x.uid for x in mine]),
+                    ItemEvent.type.in_(store.RESONANCE_TYPES),
+                )
+            ).scalars()
+        )
+        picks = sorted(
+            (x for x in mine if x.uid not in rated and scores[x.uiuid] >= SIM_FEED_MIN),
+            key=lambda x: scores[x.uiuid],
+            reverse=True,
+        )[:SIM_FEED_K]
+        for pick in picks:
+            store.suggest_similar(
+                session,
+                event.user_email,
+                pick.uid,
+                target.uid,
+                round(event.value * scores[pick.uiuid]),
+            )
+        suggested += len(picks)
+    return suggested
+
+
+def run_similarity():
+    index = SimilarityIndex()
+    if os.path.exists(SIM_INDEX_PATH):
+        index = SimilarityIndex.load(SIM_INDEX_PATH)
+    saved_at, unsaved = time.monotonic(), False
+    while True:
+        started = time.perf_counter()
+        size = len(index.keys)
+        with orm.Session(engine) as session:
+            taken = index_new_items(session, index)
+            suggested = suggest_similar(session, index)
+            session.commit()
+        if len(index.keys) > size or suggested:
+            unsaved = unsaved or len(index.keys) > size
+            print(
+                f"Indexed {len(index.keys) - size} items ({len(index.keys)} in "
+                f"total) and suggested {suggested} similar ones "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+        if unsaved and time.monotonic() - saved_at >= SIM_SAVE_INTERVAL:
+            index.save(SIM_INDEX_PATH)
+            saved_at, unsaved = time.monotonic(), False
+        if taken < SIM_BATCH:
+            time.sleep(SIM_INTERVAL)
@@ -0,0 +1,520 @@
+from collections import defaultdict
+from datetime import datetime
+from models import (
+    Article,
+    ArticleAlias,
+    ArticleFingerprint,
+    Counter,
+    ExtractionJob,
+    FeedEntry,
+    Item,
+    ItemEvent,
+    ReadingItemData,
+)
+from sqlalchemy import desc, func, or_, orm, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from utils import RANK_GAP, RECOMMEND_THRESHOLD, article_uid, generate_content_uid
+
+READING_TYPES = ("read", "do")
+RESONANCE_TYPES = ("resonance", "_resonance")
+# Meta event types that set a flag on the target's queue row
+FLAG_TYPES = {"_done": "done", "_archive": "archived"}
+META_TYPES = RESONANCE_TYPES + tuple(FLAG_TYPES)
+CHANGE_KINDS = {"done": ("done", "undone"), "archived": ("archived", "unarchived")}
+
+
+def _insert(session: orm.Session, entity):
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(entity)
+    return sqlite.insert(entity)
+
+
+def next_seq(session: orm.Session, name: str = "changes") -> int:
+    # The counter row stays write-locked until the caller commits, so sequence
+    # numbers become visible in commit order and readers can page on them
+    return session.execute(
+        _insert(session, Counter)
+        .values(name=name, value=1)
+        .on_conflict_do_update(
+            index_elements=[Counter.name], set_={"value": Counter.value + 1}
+        )
+        .returning(Counter.value)
+    ).scalar_one()
+
+
+def existing_links(
+    session: orm.Session, emails: list[str], links: list[str]
+) -> dict[str, set[str]]:
+    # Links each user has an item of, or an item of the article they alias
+    seen = defaultdict(set)
+    if not links or not emails:
+        return seen
+    for email, link in session.execute(existing_links_query(emails, links)):
+        seen[email].add(link)
+    aliases = defaultdict(list)
+    for link in links:
+        aliases[article_uid(link)].append(link)
+    for email, uid in session.execute(aliased_links_query(emails, list(aliases))):
+        seen[email].update(aliases[uid])
+    return seen
+
+
+def existing_links_query(emails: list[str], links: list[str]):
+    return select(Item.user_email, Item.link).where(
+        Item.user_email.in_(emails), Item.link.in_(links)
+    )
+
+
+def aliased_links_query(emails: list[str], uids: list[str]):
+    return (
+        select(Item.user_email, ArticleAlias.uid)
+        .join(Item, Item.article_uid == ArticleAlias.article_uid)
+        .where(ArticleAlias.uid.in_(uids), Item.user_email.in_(emails))
+    )
+
+
+def existing_articles(session: orm.Session, uids: list[str]) -> dict[str, str]:
+    # Article uid -> uid of the stored article, itself or the one it aliases
+    if not uids:
+        return {}
+    stored = {
+        uid: uid
+        for uid in session.execute(select(Article.uid).where(Article.uid.in_(uids)))
+        .scalars()
+        .all()
+    }
+    aliases = session.execute(
+        select(ArticleAlias.uid, ArticleAlias.article_uid).where(
+            ArticleAlias.uid.in_(uids)
+        )
+    )
+    return {**dict(aliases.tuples().all()), **stored}
+
+
+def insert_articles(session: orm.Session, articles: list[dict]):
+    if articles:
+        session.execute(_insert(session, Article).on_conflict_do_nothing(), articles)
+
+
+def insert_aliases(session: orm.Session, aliases: list[dict]):
+    if aliases:
+        session.execute(
+            _insert(session, ArticleAlias).on_conflict_do_nothing(), aliases
+        )
+
+
+def insert_fingerprints(session: orm.Session, rows: list[dict]):
+    if rows:
+        session.execute(
+            _insert(session, ArticleFingerprint).on_conflict_do_nothing(), rows
+        )
+
+
+def article_items(
+    session: orm.Session, emails: list[str], article_uids: list[str]
+) -> dict[tuple[str, str], str]:
+    # (email, article uid) -> uid of the user's item of that article
+    if not emails or not article_uids:
+        return {}
+    rows = session.execute(
+        select(Item.user_email, Item.article_uid, Item.uid).where(
+            Item.user_email.in_(emails), Item.article_uid.in_(article_uids)
+        )
+    )
+    return {(email, article): uid for email, article, uid in rows}
+
+
+def merge_duplicates(session: orm.Session, peer_scores: dict[str, int]):
+    # Another peer recommended a story the user already has: the best
+    # recommendation counts for their item, which is ranked again
+    if not peer_scores:
+        return
+    for uid, peer_score in peer_scores.items():
+        session.execute(
+            update(Item)
+            .where(
+                Item.uid == uid,
+                or_(Item.peer_score == None, Item.peer_score < peer_score),
+            )
+            .values(peer_score=peer_score)
+        )
+    session.execute(
+        update(ReadingItemData)
+        .where(ReadingItemData.item_uid.in_(list(peer_scores)))
+        .values(score=None)
+    )
+
+
+def insert_items(session: orm.Session, email: str, items: list[dict]) -> list[str]:
+    # Rows that lost a race on (link, user_email) are skipped instead of raising,
+    # so only the returned uids get reading data
+    if not items:
+        return []
+    uids = (
+        session.execute(
+            _insert(session, Item)
+            .on_conflict_do_nothing()
+            .returning(Item.uid, Item.type),
+            [{**item, "user_email": email} for item in items],
+        )
+        .tuples()
+        .all()
+    )
+    reading_data = [
+        {
+            "item_uid": uid,
+            "archived": False,
+            "done": False,
+            "user_email": email,
+        }
+        for uid, item_type in uids
+        if item_type in READING_TYPES
+    ]
+    if reading_data:
+        change_seq = next_seq(session)
+        bottom = bottom_rank(session, email)
+        for i, row in enumerate(reading_data):
+            row["change_seq"] = change_seq
+            row["change_kind"] = "added"
+            row["item_order"] = bottom - i * RANK_GAP
+        session.execute(
+            _insert(session, ReadingItemData).on_conflict_do_nothing(), reading_data
+        )
+    return [uid for uid, _ in uids]
+
+
+def add_pending_items(
+    session: orm.Session, email: str, links: list[str], item_type: str
+) -> list[dict]:
+    # Items whose article still has to be extracted: they are queued right away
+    # with status "pending" and an extraction job. Links the user already has
+    # come back as they are.
+    now = datetime.utcnow()
+    rows = [
+        dict(
+            uid=generate_content_uid([item_type, email, link]),
+            uiuid=generate_content_uid([item_type, link]),
+            title=None,
+            author=None,
+            content=None,
+            link=link,
+            type=item_type,
+            status="pending",
+        )
+        for link in dict.fromkeys(links)
+    ]
+    added = set(insert_items(session, email, rows))
+    if added:
+        session.execute(
+            _insert(session, ExtractionJob).on_conflict_do_nothing(),
+            [
+                dict(
+                    item_uid=row["uid"],
+                    link=row["link"],
+                    status="pending",
+                    attempts=0,
+                    next_attempt_at=now,
+                )
+                for row in rows
+                if row["uid"] in added
+            ],
+        )
+    stored = session.execute(
+        select(Item.uid, Item.link, Item.status).where(
+            Item.user_email == email, Item.link.in_([x["link"] for x in rows])
+        )
+    )
+    return [row._asdict() for row in stored]
+
+
+def mark_changed(session: orm.Session, email: str, uid: str, kind: str):
+    # Lets /get_changes clients know a queue item was rewritten
+    session.execute(
+        update(ReadingItemData)
+        .where(ReadingItemData.user_email == email, ReadingItemData.item_uid == uid)
+        .values(change_seq=next_seq(session), change_kind=kind)
+    )
+
+
+def event_value(event_type: str, content: str | None) -> int:
+    # Resonance carries an integer score, flags are set unless content says not
+    if event_type in RESONANCE_TYPES:
+        return int(content)
+    return 0 if (content or "").strip().lower() in ("0", "false") else 1
+
+
+def add_item(session: orm.Session, email: str, item: dict) -> str:
+    # Single item written through /add_item, returns the uid it is stored under.
+    # Meta events only go to item_events, `link` is the uid they target.
+    if item["type"] in META_TYPES:
+        value = event_value(item["type"], item["content"])
+        if item["type"] in RESONANCE_TYPES:
+            record_event(session, email, item["link"], item["type"], value)
+            record_resonance(session, email, item["link"], value)
+        else:
+            set_flag(session, email, item["link"], item["type"], bool(value))
+        return item["uid"]
+
+    session.add(Item(**item, user_email=email))
+    if item["type"] in READING_TYPES:
+        session.add(
+            ReadingItemData(
+                item_uid=item["uid"],
+                archived=False,
+                done=False,
+                user_email=email,
+                item_order=bottom_rank(session, email),
+                change_seq=next_seq(session),
+                change_kind="added",
+            )
+        )
+    return item["uid"]
+
+
+def record_event(
+    session: orm.Session, email: str, target_uid: str, event_type: str, value: int
+):
+    # Latest event wins: it replaces the user's previous one of the same type
+    now = datetime.utcnow()
+    seq = next_seq(session, "events")
+    stmt = _insert(session, ItemEvent).values(
+        user_email=email,
+        target_uid=target_uid,
+        type=event_type,
+        value=value,
+        created_at=now,
+        seq=seq,
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ItemEvent.user_email, ItemEvent.target_uid, ItemEvent.type],
+            set_=dict(value=value, created_at=now, seq=seq),
+        )
+    )
+
+
+def set_flag(
+    session: orm.Session, email: str, uid: str, event_type: str, value: bool
+) -> bool:
+    # Records a _done/_archive event and applies it to the queue row, False if
+    # the user has no such row
+    record_event(session, email, uid, event_type, int(value))
+    row = session.get(ReadingItemData, (uid, email))
+    if row is None:
+        return False
+    flag = FLAG_TYPES[event_type]
+    setattr(row, flag, value)
+    row.change_seq = next_seq(session)
+    row.change_kind = CHANGE_KINDS[flag][0 if value else 1]
+    return True
+
+
+def record_resonance(session: orm.Session, email: str, target_uid: str, score: int):
+    now = datetime.utcnow()
+    if score > RECOMMEND_THRESHOLD:
+        seq = next_seq(session, "feed")
+        session.execute(
+            _insert(session, FeedEntry)
+            .values(
+                user_email=email,
+                item_uid=target_uid,
+                score=score,
+                active=True,
+                seq=seq,
+                updated_at=now,
+            )
+            .on_conflict_do_update(
+                index_elements=[FeedEntry.user_email, FeedEntry.item_uid],
+                set_=dict(
+                    score=score, active=True, seq=seq, updated_at=now, similar_to=None
+                ),
+            )
+        )
+        return
+    # Dropped below the threshold: keep a tombstone so the feed version moves,
+    # for the entry and for the suggestions made because of it
+    entries = session.scalars(
+        select(FeedEntry).where(
+            FeedEntry.user_email == email,
+            FeedEntry.active == True,
+            or_(FeedEntry.item_uid == target_uid, FeedEntry.similar_to == target_uid),
+        )
+    )
+    for entry in entries:
+        if entry.item_uid == target_uid:
+            entry.score = score
+            entry.similar_to = None
+        entry.active = False
+        entry.seq = next_seq(session, "feed")
+        entry.updated_at = now
+
+
+def suggest_similar(
+    session: orm.Session, email: str, item_uid: str, similar_to: str, score: int
+):
+    # Recommends the unrated `item_uid` for being like `similar_to`. Entries
+    # the user made themselves, or took back, are left alone.
+    session.execute(
+        _insert(session, FeedEntry)
+        .values(
+            user_email=email,
+            item_uid=item_uid,
+            score=score,
+            active=True,
+            seq=next_seq(session, "feed"),
+            updated_at=datetime.utcnow(),
+            similar_to=similar_to,
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+def bottom_rank(session: orm.Session, email: str) -> int:
+    # Rank for a new item at the end of the user's queue
+    lowest = session.execute(
+        select(func.min(ReadingItemData.item_order)).where(
+            ReadingItemData.user_email == email, ReadingItemData.archived == False
+        )
+    ).scalar()
+    return 0 if lowest is None else lowest - RANK_GAP
+
+
+def rank_between(above: int | None, below: int | None) -> int | None:
+    if above is None and below is None:
+        return 0
+    if above is None:
+        return below + RANK_GAP
+    if below is None:
+        return above - RANK_GAP
+    if above - below < 2:
+        return None
+    return (above + below) // 2
+
+
+def _adjacent_rank(
+    session: orm.Session,
+    email: str,
+    rank: int,
+    higher: bool,
+    moved: dict,
+    moving_uid: str,
+) -> int | None:
+    # Closest rank above/below `rank`, where ranks moved earlier in the same
+    # batch (`moved`) override what is stored
+    column = ReadingItemData.item_order
+    stored = session.execute(
+        select(column)
+        .where(
+            ReadingItemData.user_email == email,
+            ReadingItemData.archived == False,
+            column > rank if higher else column < rank,
+            ReadingItemData.item_uid.not_in([*moved, moving_uid]),
+        )
+        .order_by(column if higher else desc(column))
+        .limit(1)
+    ).scalar()
+    candidates = [x for x in moved.values() if (x > rank if higher else x < rank)]
+    if stored is not None:
+        candidates.append(stored)
+    if not candidates:
+        return None
+    return min(candidates) if higher else max(candidates)
+
+
+def rebalance_ranks(session: orm.Session, email: str, change_seq: int):
+    rows = session.execute(
+        select(ReadingItemData.item_uid)
+        .where(ReadingItemData.user_email == email)
+        .order_by(desc(ReadingItemData.item_order), ReadingItemData.item_uid)
+    ).scalars()
+    session.execute(
+        update(ReadingItemData),
+        [
+            {
+                "item_uid": uid,
+                "user_email": email,
+                "item_order": -i * RANK_GAP,
+                "change_seq": change_seq,
+                "change_kind": "reordered",
+            }
+            for i, uid in enumerate(rows)
+        ],
+    )
+
+
+def reorder(session: orm.Session, email: str, moves: list[dict]) -> dict[str, int]:
+    # Each move is {"uid", "order"} for an absolute rank, or {"uid", "before"} /
+    # {"uid", "after"} to place it directly above/below another item. The whole
+    # batch is written with one bulk update.
+    anchors = {x.get("before") or x.get("after") for x in moves} - {None}
+    uids = {x["uid"] for x in moves} | anchors
+    ranks = _read_ranks(session, email, uids)
+    missing = uids - set(ranks)
+    if missing:
+        raise KeyError(f"Unknown items: {sorted(missing)}")
+
+    change_seq = next_seq(session)
+    moved = {}
+    for move in moves:
+        if move.get("order") is not None:
+            moved[move["uid"]] = move["order"]
+            continue
+        # Take the item out while looking for its new neighbours
+        moved.pop(move["uid"], None)
+        anchor = move.get("before") or move.get("after")
+        anchor_rank = moved.get(anchor, ranks.get(anchor))
+        if anchor_rank is None:
+            raise KeyError(f"Item `{anchor}` has no rank")
+        for attempt in range(2):
+            if move.get("before"):
+                above = _adjacent_rank(
+                    session, email, anchor_rank, True, moved, move["uid"]
+                )
+                rank = rank_between(above, anchor_rank)
+            else:
+                below = _adjacent_rank(
+                    session, email, anchor_rank, False, moved, move["uid"]
+                )
+                rank = rank_between(anchor_rank, below)
+            if rank is not None or attempt:
+                break
+            # Ran out of room between the neighbours, respace the whole queue.
+            # Every rank read so far is stale after that.
+            _write_ranks(session, email, moved, change_seq)
+            moved = {}
+            rebalance_ranks(session, email, change_seq)
+            ranks = _read_ranks(session, email, uids)
+            anchor_rank = ranks[anchor]
+        moved[move["uid"]] = rank
+    _write_ranks(session, email, moved, change_seq)
+    return moved
+
+
+def _read_ranks(session: orm.Session, email: str, uids: set[str]) -> dict:
+    return dict(
+        session.execute(
+            select(ReadingItemData.item_uid, ReadingItemData.item_order).where(
+                ReadingItemData.user_email == email,
+                ReadingItemData.item_uid.in_(uids),
+            )
+        )
+        .tuples()
+        .all()
+    )
+
+
+def _write_ranks(session: orm.Session, email: str, ranks: dict, change_seq: int):
+    if ranks:
+        session.execute(
+            update(ReadingItemData),
+            [
+                {
+                    "item_uid": uid,
+                    "user_email": email,
+                    "item_order": rank,
+                    "change_seq": change_seq,
+                    "change_kind": "reordered",
+                }
+                for uid, rank in ranks.items()
+            ],
+        )
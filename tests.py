@@ -1,8 +1,23 @@
+from sqlalchemy.dialects import sqlite
 import requests
 import sqlite3
+import asyncio
+import datetime
 import json
 import os
+import random
+import re
+import tempfile
 import time
+import cron_consumer
+import dedup
+import diffbot
+import extraction
+import fake_diffbot
+import item_to_mp3
+import main
+import ranking
+import store
 
 
 # A server runs on 8080 using spile.db with and admin account
@@ -58,6 +73,80 @@ for auth_token in [user1_auth, user2_auth]:
     ).json()["items"]
     assert len(items) == 1
 
+# The list only carries summaries, the content is fetched per item
+for auth_token in [user1_auth, user2_auth]:
+    items = requests.get(
+        base + "/get_items", headers={"auth_token": auth_token}
+    ).json()["items"]
+    assert "content" not in items[0]
+    item = requests.get(
+        base + f"/get_item/{items[0]['uid']}", headers={"auth_token": auth_token}
+    ).json()
+    assert item["content"] == "This is a long string of text"
+
+# Cursors of the wrong shape are rejected
+for path in ["/get_items", "/get_changes"]:
+    for cursor in ["NQ==", "WyJhIl0=", "WzEsIDJd"]:
+        resp = requests.get(
+            base + path, headers={"auth_token": user1_auth}, params={"cursor": cursor}
+        )
+        assert resp.status_code == 400
+for cursor in ["NQ==", "WyJhIl0=", "Wy0xXQ=="]:
+    resp = requests.get(
+        base + "/search",
+        headers={"auth_token": user1_auth},
+        params={"q": "hello", "cursor": cursor},
+    )
+    assert resp.status_code == 400
+
+# Search only sees the user's own items and marks the matches
+resp = requests.get(
+    base + "/search", headers={"auth_token": user1_auth}, params={"q": "hello strings"}
+).json()
+assert [x["title"] for x in resp["items"]] == [f"Hello from {user1_email}"]
+assert resp["items"][0]["title_highlight"].startswith("<mark>Hello</mark>")
+assert "<mark>string</mark>" in resp["items"][0]["snippet"]
+resp = requests.get(
+    base + "/search", headers={"auth_token": user1_auth}, params={"q": "hel* user2"}
+).json()
+assert resp["items"] == []
+
+# The recommender scores new queue rows in the background
+for _ in range(50):
+    ranked = requests.get(
+        base + "/get_items",
+        headers={"auth_token": user1_auth},
+        params={"order": "model"},
+    ).json()["items"]
+    if ranked[0]["score"] is not None:
+        break
+    time.sleep(0.2)
+assert ranked[0]["score"] is not None
+
+# Audio is streamed, with the offline synthesizer when the server runs with it
+if os.environ.get("WM_TTS_BACKEND") == "silent":
+    resp = requests.get(
+        base + f"/get_mp3/{items[0]['uid']}", headers={"auth_token": user2_auth}
+    )
+    assert resp.headers["content-type"] == "audio/mpeg"
+    assert resp.content[:2] == b"\xff\xfb"
+    # The second time it comes from the cache
+    cached = requests.get(
+        base + f"/get_mp3/{items[0]['uid']}", headers={"auth_token": user2_auth}
+    )
+    assert cached.content == resp.content
+
+
+# Content with nothing to read out renders no audio, and none is cached
+async def follow_render(cache, uiuid, content):
+    render = cache.render(uiuid, content, item_to_mp3.silent_synthesize)
+    return [part async for part in render.follow()]
+
+
+cache = item_to_mp3.Mp3Cache(tempfile.mkdtemp(), 1 << 20)
+assert asyncio.run(follow_render(cache, "empty", "")) == []
+assert not os.path.exists(cache.path("empty"))
+
 
 # Now subscribe them to each other
 resp = requests.post(
@@ -127,10 +216,76 @@ items = requests.get(base + "/get_items", headers={"auth_token": user1_auth}).js
 ]
 assert len(items) == 1
 
+# user1's feed holds the one recommendation, unchanged feeds answer 304
+resp = requests.get(base + f"/get_feed/{user1_email}")
+assert len(resp.json()) == 1
+resp = requests.get(
+    base + f"/get_feed/{user1_email}",
+    headers={"If-None-Match": resp.headers["ETag"]},
+)
+assert resp.status_code == 304
+
+# Re-scoring replaces the earlier rating and takes the item off the feed
+user1_read_item = requests.get(
+    base + "/get_items", headers={"auth_token": user1_auth}
+).json()["items"][0]
+feed_cursor = int(resp.headers["X-Feed-Cursor"])
+for score, feed_length in [("20", 0), ("95", 1)]:
+    res = requests.post(
+        base + "/add_item",
+        headers={"auth_token": user1_auth},
+        json={
+            "content": score,
+            "link": user1_read_item["uid"],
+            "type": "resonance",
+        },
+    )
+    assert res.status_code == 200
+    assert len(requests.get(base + f"/get_feed/{user1_email}").json()) == feed_length
+top = requests.get(base + f"/get_feed/{user1_email}", params={"top": 1}).json()
+assert top[0]["reasons"] == [{"resonance": 95}]
+assert not requests.get(
+    base + f"/get_feed/{user1_email}", params={"min_score": 96}
+).json()
+
+# Peers holding a cursor only get what changed since, streamed on request
+resp = requests.get(
+    base + f"/get_feed/{user1_email}",
+    params={"since": feed_cursor},
+    headers={"Accept": "application/x-ndjson", "Accept-Encoding": "gzip"},
+)
+assert resp.headers["Content-Encoding"] == "gzip"
+changed = [json.loads(line) for line in resp.text.splitlines()]
+assert [x["removed"] for x in changed] == [False]
+assert changed[0]["seq"] == int(resp.headers["X-Feed-Cursor"]) > feed_cursor
+plain = requests.get(
+    base + f"/get_feed/{user1_email}",
+    params={"since": feed_cursor},
+    headers={"Accept": "application/x-ndjson", "Accept-Encoding": "gzip;q=0"},
+)
+assert "Content-Encoding" not in plain.headers
+assert plain.headers["Vary"] == "Accept, Accept-Encoding"
+assert plain.headers["ETag"] != resp.headers["ETag"]
+
+# The same changes are pushed to peers following the feed's event stream
+with requests.get(
+    base + f"/get_feed/{user1_email}/stream",
+    params={"since": feed_cursor},
+    stream=True,
+    timeout=10,
+) as resp:
+    lines = resp.iter_lines(decode_unicode=True)
+    event = dict(line.split(": ", 1) for line in iter(lambda: next(lines), ""))
+assert int(event["id"]) == changed[0]["seq"]
+assert json.loads(event["data"])["read"]["uid"] == changed[0]["read"]["uid"]
+
 # Test Item Archive and Order
 items = requests.get(base + "/get_items", headers={"auth_token": user2_auth}).json()[
     "items"
 ]
+changes = requests.get(base + "/get_changes", headers={"auth_token": user2_auth})
+cursor, etag = changes.json()["cursor"], changes.headers["ETag"]
+assert len(changes.json()["changes"]) == 2
 
 resp = requests.post(
     base + "/archive",
@@ -147,15 +302,416 @@ items = requests.get(base + "/get_items", headers={"auth_token": user2_auth}).js
 ]
 assert len(items) == 1
 
-resp = requests.post(
-    base + "/done",
+# Only the archived item shows up as a change since the last sync
+changes = requests.get(
+    base + "/get_changes",
     headers={"auth_token": user2_auth},
-    json={
-        "uid": items[0]["uid"],
-        "done": True,
-    },
+    params={"cursor": cursor},
+).json()
+assert len(changes["changes"]) == 1 and changes["changes"][0]["removed"]
+assert changes["changes"][0]["kind"] == "archived"
+resp = requests.get(
+    base + "/get_changes",
+    headers={"auth_token": user2_auth, "If-None-Match": etag},
+    params={"cursor": cursor},
 )
 assert resp.status_code == 200
+resp = requests.get(
+    base + "/get_changes",
+    headers={"auth_token": user2_auth, "If-None-Match": resp.headers["ETag"]},
+    params={"cursor": cursor},
+)
+assert resp.status_code == 304
+page = requests.get(
+    base + "/get_changes", headers={"auth_token": user2_auth}, params={"limit": 1}
+)
+assert page.json()["has_more"]
+resp = requests.get(
+    base + "/get_changes",
+    headers={"auth_token": user2_auth, "If-None-Match": page.headers["ETag"]},
+    params={"limit": 1, "cursor": page.json()["cursor"]},
+)
+assert resp.status_code == 200 and resp.json()["changes"]
+
+# Readers following the change stream get pushed the write. Their url
+# carries a short lived stream token, never the auth token.
+resp = requests.get(
+    base + "/get_changes/stream", params={"auth_token": user2_auth}, timeout=10
+)
+assert resp.status_code == 401
+stream_token = requests.post(
+    base + "/stream_token", headers={"auth_token": user2_auth}
+).json()["stream_token"]
+with requests.get(
+    base + "/get_changes/stream",
+    params={"stream_token": stream_token, "cursor": changes["cursor"]},
+    stream=True,
+    timeout=10,
+) as stream:
+    resp = requests.post(
+        base + "/done",
+        headers={"auth_token": user2_auth},
+        json={
+            "uid": items[0]["uid"],
+            "done": True,
+        },
+    )
+    assert resp.status_code == 200
+    lines = stream.iter_lines(decode_unicode=True)
+    event = dict(line.split(": ", 1) for line in iter(lambda: next(lines), ""))
+pushed = json.loads(event["data"])["changes"]
+assert [(x["uid"], x["kind"]) for x in pushed] == [(items[0]["uid"], "done")]
+
+# Links without content are queued right away and extracted in the background
+resp = requests.post(
+    base + "/add_links",
+    headers={"auth_token": user2_auth},
+    json={"links": ["https://example.com/a", "https://example.com/b"]},
+)
+assert resp.status_code == 202
+pending = resp.json()["items"]
+assert [x["status"] for x in pending] == ["pending", "pending"]
+items = requests.get(base + "/get_items", headers={"auth_token": user2_auth}).json()[
+    "items"
+]
+assert {x["uid"]: x["status"] for x in items if x["status"]} == {
+    x["uid"]: "pending" for x in pending
+}
+resp = requests.get(
+    base + f"/get_item_status/{pending[0]['uid']}", headers={"auth_token": user2_auth}
+)
+assert resp.json()["status"] in ("pending", "ready", "failed")
+
+# With WM_DIFFBOT_URL on a local fake_diffbot.py the extraction completes
+if os.environ.get("WM_DIFFBOT_URL"):
+    for _ in range(50):
+        statuses = [
+            requests.get(
+                base + f"/get_item_status/{x['uid']}",
+                headers={"auth_token": user2_auth},
+            ).json()["status"]
+            for x in pending
+        ]
+        if statuses == ["ready", "ready"]:
+            break
+        time.sleep(0.2)
+    assert statuses == ["ready", "ready"]
+
+    # Items of an article that is already stored get its title too
+    again = requests.post(
+        base + "/add_links",
+        headers={"auth_token": user1_auth},
+        json={"links": ["https://example.com/a"]},
+    ).json()["items"][0]
+    for _ in range(50):
+        status = requests.get(
+            base + f"/get_item_status/{again['uid']}",
+            headers={"auth_token": user1_auth},
+        ).json()["status"]
+        if status == "ready":
+            break
+        time.sleep(0.2)
+    titles = [
+        requests.get(base + f"/get_item/{uid}", headers={"auth_token": auth}).json()[
+            "title"
+        ]
+        for uid, auth in [(pending[0]["uid"], user2_auth), (again["uid"], user1_auth)]
+    ]
+    assert titles[0] and titles[0] == titles[1]
+
+    # Its Atom feeds are streamed in like RSS
+    fake_base = os.environ["WM_DIFFBOT_URL"].removesuffix("/v3/article")
+    requests.post(
+        base + "/add_source",
+        headers={"auth_token": user2_auth},
+        json={"source": fake_base + "/atom/tests?items=5"},
+    )
+    for _ in range(100):
+        items = requests.get(
+            base + "/get_items", headers={"auth_token": user2_auth}
+        ).json()["items"]
+        if len([x for x in items if "/articles/tests/" in x["link"]]) == 5:
+            break
+        time.sleep(0.2)
+    assert len([x for x in items if "/articles/tests/" in x["link"]]) == 5
+
+    # Entries that can't be extracted fail alone, the rest of the feed is stored
+    requests.post(
+        base + "/add_source",
+        headers={"auth_token": user2_auth},
+        json={"source": fake_base + "/rss/dead?items=4&missing=2"},
+    )
+    for _ in range(100):
+        items = requests.get(
+            base + "/get_items", headers={"auth_token": user2_auth}
+        ).json()["items"]
+        dead = sorted(
+            (x["link"].split("/")[-3], x["status"])
+            for x in items
+            if "/dead/" in x["link"]
+        )
+        if len(dead) == 4:
+            break
+        time.sleep(0.2)
+    assert dead == [
+        ("articles", None),
+        ("articles", None),
+        ("missing", "failed"),
+        ("missing", "failed"),
+    ]
+    failed = next(x for x in items if x["status"] == "failed")
+    resp = requests.get(
+        base + f"/get_mp3/{failed['uid']}", headers={"auth_token": user2_auth}
+    )
+    assert resp.status_code == 409
+
+# Items like one the user rated highly are found and suggested on their feed
+user3_email = "user3@test.com"
+user3_auth = requests.post(
+    base + "/create_user",
+    headers={"auth_token": admin_auth_token},
+    json={"email": user3_email, "is_admin": False},
+).json()["auth_token"]
+for i, content in enumerate(
+    [
+        "Sourdough bread needs a lively starter, flour, water and a long proof",
+        "A sourdough starter, good flour and patience make the best bread",
+        "Compilers turn source code into machine instructions",
+    ]
+):
+    requests.post(
+        base + "/add_item",
+        headers={"auth_token": user3_auth},
+        json={"content": content, "link": f"similar.test/{i}", "type": "read"},
+    )
+uids = {
+    x["link"]: x["uid"]
+    for x in requests.get(
+        base + "/get_items", headers={"auth_token": user3_auth}
+    ).json()["items"]
+}
+for _ in range(100):
+    similar = requests.get(
+        base + f"/similar/{uids['similar.test/0']}", headers={"auth_token": user3_auth}
+    ).json()["items"]
+    if similar:
+        break
+    time.sleep(0.2)
+assert [x["uid"] for x in similar][:1] == [uids["similar.test/1"]]
+requests.post(
+    base + "/add_item",
+    headers={"auth_token": user3_auth},
+    json={"content": "95", "link": uids["similar.test/0"], "type": "resonance"},
+)
+for _ in range(50):
+    feed = requests.get(base + f"/get_feed/{user3_email}").json()
+    if len(feed) == 2:
+        break
+    time.sleep(0.2)
+assert feed[1]["read"]["uid"] == uids["similar.test/1"]
+assert feed[1]["reasons"][0]["similar_to"] == uids["similar.test/0"]
+
+# The same story under two links reaches subscribers once
+user4_email, user5_email = "user4@test.com", "user5@test.com"
+user4_auth, user5_auth = [
+    requests.post(
+        base + "/create_user",
+        headers={"auth_token": admin_auth_token},
+        json={"email": email, "is_admin": False},
+    ).json()["auth_token"]
+    for email in (user4_email, user5_email)
+]
+story = (
+    "The city council voted on Tuesday to turn the old rail yard into a park, "
+    "ending a decade of debate over housing, offices and a stadium on the site"
+)
+for link in ("news.test/park", "wire.test/2024/council-park"):
+    requests.post(
+        base + "/add_item",
+        headers={"auth_token": user5_auth},
+        json={
+            "title": "Rail yard becomes a park",
+            "content": story,
+            "link": link,
+            "type": "read",
+        },
+    )
+for item in requests.get(
+    base + "/get_items", headers={"auth_token": user5_auth}
+).json()["items"]:
+    requests.post(
+        base + "/add_item",
+        headers={"auth_token": user5_auth},
+        json={"content": "95", "link": item["uid"], "type": "resonance"},
+    )
+requests.post(
+    base + "/add_source",
+    headers={"auth_token": user4_auth},
+    json={"source": base + f"/get_feed/{user5_email}"},
+)
+for _ in range(50):
+    items = requests.get(
+        base + "/get_items", headers={"auth_token": user4_auth}
+    ).json()["items"]
+    if items:
+        break
+    time.sleep(0.2)
+time.sleep(1)
+items = requests.get(base + "/get_items", headers={"auth_token": user4_auth}).json()[
+    "items"
+]
+assert len(items) == 1
+
+# A teaser duplicate of an entry that is itself a duplicate of a stored
+# article ends up at the stored one
+user6_email = "user6@test.com"
+user6_auth = requests.post(
+    base + "/create_user",
+    headers={"auth_token": admin_auth_token},
+    json={"email": user6_email, "is_admin": False},
+).json()["auth_token"]
+for link, content in (
+    ("mirror.test/park", story),
+    ("mirror.test/park-amp", "Page not found, try the search box or go home"),
+):
+    uid = requests.post(
+        base + "/add_item",
+        headers={"auth_token": user6_auth},
+        json={
+            "title": "Council votes to turn the old rail yard into a city park",
+            "content": content,
+            "link": link,
+            "type": "read",
+        },
+    ).json()["uid"]
+    requests.post(
+        base + "/add_item",
+        headers={"auth_token": user6_auth},
+        json={"content": "95", "link": uid, "type": "resonance"},
+    )
+requests.post(
+    base + "/add_source",
+    headers={"auth_token": user4_auth},
+    json={"source": base + f"/get_feed/{user6_email}"},
+)
+time.sleep(3)
+items = requests.get(base + "/get_items", headers={"auth_token": user4_auth}).json()[
+    "items"
+]
+assert len(items) == 1
+# The links merged into it are known, the next poll doesn't take them for new
+entries = [
+    {"link": link, "published": None}
+    for link in ("mirror.test/park", "mirror.test/park-amp", "news.test/park")
+]
+unseen, _ = cron_consumer.unseen_entries(entries, [user4_email], None, True)
+assert unseen == []
+
+# Moves in one /order batch see the ranks left by the ones before them, even
+# when one had to respace the queue
+user7_auth = requests.post(
+    base + "/create_user",
+    headers={"auth_token": admin_auth_token},
+    json={"email": "user7@test.com", "is_admin": False},
+).json()["auth_token"]
+uids = {
+    title: requests.post(
+        base + "/add_item",
+        headers={"auth_token": user7_auth},
+        json={
+            "title": title,
+            "content": f"Item {title}",
+            "link": f"order.test/{title}",
+            "type": "read",
+        },
+    ).json()["uid"]
+    for title in "abcde"
+}
+for moves in (
+    [{"uid": uids[x], "order": rank} for x, rank in zip("abcde", [10, 9, 8, 0, -100])],
+    [
+        {"uid": uids["e"], "before": uids["b"]},
+        {"uid": uids["d"], "after": uids["a"]},
+    ],
+):
+    resp = requests.post(
+        base + "/order", headers={"auth_token": user7_auth}, json={"items": moves}
+    )
+    assert resp.status_code == 200
+items = requests.get(base + "/get_items", headers={"auth_token": user7_auth}).json()[
+    "items"
+]
+assert [x["title"] for x in items] == list("adebc")
+
+# A half-open trial that gets throttled doesn't leave the breaker stuck open
+client = diffbot.DiffbotClient(token="x", rate=1000, retries=0)
+client.breaker = diffbot.CircuitBreaker(threshold=1, cooldown=0)
+answers = [
+    diffbot.RetryableError("HTTP 502"),
+    diffbot.RetryableError("HTTP 429", retry_after=0.01),
+    {"html": "<p>Up again</p>"},
+]
+
+
+def answer(link):
+    result = answers.pop(0)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+client._request = answer
+for expected in ["HTTP 502", "HTTP 429"]:
+    try:
+        client.article("https://example.com/trial")
+    except diffbot.RetryableError as e:
+        assert str(e) == expected
+assert client.article("https://example.com/trial") == {"html": "<p>Up again</p>"}
+
+# Unrelated texts over a small vocabulary, like the stand-in extraction API
+# serves, aren't taken for the same story
+rng = random.Random(1)
+texts = [re.sub("<[^>]+>", " ", fake_diffbot.article_html(str(i))[1]) for i in range(100)]
+texts += [" ".join(rng.choices(fake_diffbot.WORDS, k=60)) for _ in range(100)]
+hashes = [dedup.simhash(x) for x in texts]
+close = sum(
+    dedup.distance(a, b) <= dedup.DEDUP_DISTANCE
+    for i, a in enumerate(hashes)
+    for b in hashes[i + 1 :]
+)
+assert close / (len(hashes) * (len(hashes) - 1) / 2) < 0.001
+
+# The hot queries must be served by indexes, never by full table scans. The
+# statements are the ones the code runs, compiled with example values.
+db = sqlite3.connect("spile.db")
+now = datetime.datetime.utcnow()
+hot_queries = {
+    "auth": main.identity_query("x"),
+    "get_items": main.items_query("x", "queue", (1, "x"), 100),
+    "get_items_model": main.items_query("x", "model", (0.5, "x"), 100),
+    "get_changes": main.changes_query("x", (1, "x"), 500),
+    "get_changes_etag": main.changes_version_query("x"),
+    "get_feed_version": main.feed_version_query("x"),
+    "get_feed": main.feed_query("x", None),
+    "get_feed_since": main.feed_query("x", 1, 10),
+    "get_feed_top": main.feed_query("x", None, min_score=90, top=10),
+    "get_sources": main.sources_query("x"),
+    "claim_jobs": extraction.due_jobs_query(now, 4),
+    "rank_changed": ranking.events_query(1),
+    "peer_ratings": ranking.peer_ratings_query(["x", "y"]),
+    "near_duplicates": dedup.band_query([1, 2, 3, 4]),
+    "due_sources": cron_consumer.due_sources_query(now),
+    "existing_links": store.existing_links_query(["x", "y"], ["x", "y"]),
+    "aliased_links": store.aliased_links_query(["x", "y"], ["x", "y"]),
+}
+for name, query in hot_queries.items():
+    sql = query.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True})
+    plan = [row[3] for row in db.execute(f"EXPLAIN QUERY PLAN {sql}")]
+    assert not any(x.startswith("SCAN") or "TEMP B-TREE" in x for x in plan), (
+        name,
+        plan,
+    )
+db.close()
 
 # Subscribe user1 to nintil's RSS
 resp = requests.post(
@@ -14,28 +14,32 @@ import sqlite3
 from uuid import uuid4
 import threading
 import time
-from hashlib import md5
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from hashlib import md5, sha256
+import hmac
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 from fastapi.middleware.cors import CORSMiddleware
-from rss_parser import Parser
-import markdownify
+from html_to_md import html_to_md
+import diffbot
 
 
 def link_to_md(link: str):
-    obj = requests.get(
-        f"https://api.diffbot.com/v3/article?url={link}&token=6165e93d46dfa342d862a975c813a296"
-    ).json()
-    html = obj["objects"][0]["html"]
-    md = markdownify.markdownify(html, heading_style="ATX")
-    return md
+    return html_to_md(diffbot.client.article(link)["html"], link)
 
 
 def get_all_from_link(link: str):
-    obj = requests.get(
-        f"https://api.diffbot.com/v3/article?url={link}&token=6165e93d46dfa342d862a975c813a296"
-    ).json()
-    return obj["objects"][0]
+    return diffbot.client.article(link)
 
 
+# Queue ranks (ReadingItemData.item_order, highest first) are spaced this far
+# apart, so moving an item only rewrites that item's rank
+RANK_GAP = 1 << 16
+# Items rated above this are recommended to peers through /get_feed
+RECOMMEND_THRESHOLD = int(os.environ.get("WM_RECOMMEND_THRESHOLD", 80))
+
 
 def detect_source_type(source: str):
     if "@" in source and "get_feed" in source:
@@ -47,7 +51,166 @@ def generate_auth_token():
     return str(uuid4())
 
 
+def encode_cursor(position: list) -> str:
+    return urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, *types) -> list:
+    # `types`, when given, holds what each position of the cursor may be,
+    # e.g. (int, str)
+    try:
+        position = json.loads(urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor `{cursor}`") from e
+    if types and (
+        not isinstance(position, list)
+        or len(position) != len(types)
+        or any(
+            isinstance(x, bool) or not isinstance(x, t) for x, t in zip(position, types)
+        )
+    ):
+        raise ValueError(f"Invalid cursor `{cursor}`")
+    return position
+
+
+def fts_phrase(text: str) -> str:
+    return '"' + text.replace('"', '""') + '"'
+
+
+def fts_query(query: str) -> str:
+    # Free text to an FTS5 expression: every word has to match, `word*` is a
+    # prefix search and any other syntax is taken literally
+    terms = []
+    for word in query.split():
+        if word.strip('*"'):
+            terms.append(
+                fts_phrase(word.rstrip("*")) + ("*" if word[-1] == "*" else "")
+            )
+    return " ".join(terms)
+
+
+def http_date(value: datetime) -> str:
+    # Naive datetimes from the db are UTC
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+
+def not_modified(request, headers: dict) -> bool:
+    # Whether a conditional GET can be answered with 304 given the response's
+    # ETag / Last-Modified headers
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match == headers.get("ETag")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or "Last-Modified" not in headers:
+        return False
+    try:
+        return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(
+            headers["Last-Modified"]
+        )
+    except (TypeError, ValueError):
+        return False
+
+
+def accepts(header: str | None, value: str, wildcard: str | None = None) -> bool:
+    # Whether an Accept style header lists `value`, or else `wildcard`, with a
+    # non-zero quality ("gzip;q=0" refuses gzip)
+    qualities = {}
+    for part in (header or "").split(","):
+        name, *params = [x.strip() for x in part.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, number = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.lower()] = quality
+    if value in qualities:
+        return qualities[value] > 0
+    return wildcard is not None and qualities.get(wildcard, 0) > 0
+
+
+def hash_auth_token(auth_token: str) -> str:
+    # Tokens are random uuids, so an unsalted fast hash is enough to keep the
+    # plaintext out of the db while staying an indexed equality lookup
+    return sha256(auth_token.encode("utf-8")).hexdigest()
+
+
+def stream_token_signature(email: str, expires: int, auth_token_hash: str) -> str:
+    # Keyed by the user's token hash: no secret to share between workers, and
+    # a new auth token voids the stream tokens made with the old one
+    message = f"stream {email} {expires}".encode("utf-8")
+    return hmac.new(auth_token_hash.encode("utf-8"), message, sha256).hexdigest()
+
+
+def make_stream_token(email: str, auth_token_hash: str, ttl: float) -> str:
+    expires = int(time.time() + ttl)
+    signature = stream_token_signature(email, expires, auth_token_hash)
+    return encode_cursor([email, expires, signature])
+
+
+def read_stream_token(stream_token: str) -> tuple[str, int, str]:
+    # (email, expires, signature), checked against the user by the caller
+    return tuple(decode_cursor(stream_token, str, int, str))
+
+
+class TTLCache:
+    # Bounded LRU where entries also expire `ttl` seconds after being set
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        for key in [k for k, (_, v) in self.entries.items() if predicate(k, v)]:
+            del self.entries[key]
+
+
 def generate_content_uid(content: str | list[object]):
     if isinstance(content, list):
         content = " --- ".join([str(x) for x in content])
     return str(md5(content.encode("utf-8")).hexdigest())
+
+
+def normalize_link(link: str) -> str:
+    # Same article under different tracking params / casing / fragments
+    parts = urlsplit(link.strip())
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query) if not k.lower().startswith("utm_")
+    ]
+    netloc = parts.netloc.lower()
+    if parts.scheme == "http" and netloc.endswith(":80"):
+        netloc = netloc[:-3]
+    if parts.scheme == "https" and netloc.endswith(":443"):
+        netloc = netloc[:-4]
+    return urlunsplit(
+        (
+            parts.scheme.lower(),
+            netloc,
+            parts.path.rstrip("/") or "/",
+            urlencode(query),
+            "",
+        )
+    )
+
+
+def article_uid(link: str) -> str:
+    return generate_content_uid(normalize_link(link))